@@ -0,0 +1,114 @@
+import json
+import logging
+import sqlite3
+import time
+from typing import Iterable, NamedTuple
+
+from DeliveryLedger import Notification
+from Event import Event
+from SqliteStorage import SqliteDatabase
+
+
+class FeedEntry(NamedTuple):
+    """The changes found by one polling cycle"""
+
+    seq: int
+    created_at: float
+    events: list[Event]
+    removed: list[int]
+    rendered: list[tuple[Notification, str]]
+
+
+class ChangeFeed:
+    """
+    A durable queue of changes to events, stored in SQLite, for running the
+    poller and the Discord client as separate processes. The poller publishes
+    the updated events and the rendered notifications of each cycle, and the
+    client consumes them in order and fans the notifications out to the
+    outbox. Entries are only removed once acknowledged, so a crashed consumer
+    consumes them again, which is harmless as the outbox and the delivery
+    ledger ignore notifications that are already queued or delivered.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS feed (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            created_at REAL,
+            events TEXT,
+            removed TEXT,
+            rendered TEXT
+        );
+    """
+
+    def __init__(self, database: SqliteDatabase):
+        self.database = database
+
+    async def publish(
+        self,
+        events: Iterable[Event],
+        rendered: list[tuple[Notification, str]] = (),
+        removed: Iterable[int] = (),
+    ) -> None:
+        """
+        Publishes the updated events, the rendered notifications about them
+        and the ids of removed events as one entry.
+        Events are stored as arrays of their fields, like in the journal.
+        """
+        row = (
+            time.time(),
+            json.dumps(
+                [list(event.to_json().values()) for event in events],
+                ensure_ascii=False,
+            ),
+            json.dumps(list(removed)),
+            json.dumps(
+                [[*notification, message] for notification, message in rendered],
+                ensure_ascii=False,
+            ),
+        )
+
+        def insert(connection: sqlite3.Connection) -> None:
+            connection.execute(
+                "INSERT INTO feed (created_at, events, removed, rendered) "
+                "VALUES (?, ?, ?, ?)",
+                row,
+            )
+
+        await self.database.run(insert)
+        logging.debug(f"Published changes with {len(rendered)} notifications")
+
+    async def read(self, limit: int) -> list[FeedEntry]:
+        """Returns at most limit unacknowledged entries, oldest first"""
+
+        def select(connection: sqlite3.Connection) -> list[tuple]:
+            return connection.execute(
+                "SELECT seq, created_at, events, removed, rendered FROM feed "
+                "ORDER BY seq LIMIT ?",
+                (limit,),
+            ).fetchall()
+
+        rows = await self.database.run(select)
+        return [
+            FeedEntry(
+                seq,
+                created_at,
+                [Event(*fields) for fields in json.loads(events)],
+                json.loads(removed),
+                [
+                    (Notification(event_id, kind, stamp), message)
+                    for event_id, kind, stamp, message in json.loads(rendered)
+                ],
+            )
+            for seq, created_at, events, removed, rendered in rows
+        ]
+
+    async def acknowledge(self, seq: int) -> None:
+        """Removes the entries up to and including seq"""
+
+        def delete(connection: sqlite3.Connection) -> None:
+            connection.execute("DELETE FROM feed WHERE seq <= ?", (seq,))
+
+        await self.database.run(delete)
+
+    async def close(self) -> None:
+        await self.database.close()
@@ -0,0 +1,309 @@
+import asyncio
+import datetime
+import json
+import logging
+import mmap
+import struct
+import sys
+from abc import ABC, abstractmethod
+from typing import Iterator
+
+import aiofiles
+
+from Event import Event
+from EventRecord import EventRecord
+from HelperFunctions import write_atomic
+
+EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+NAIVE_EPOCH = datetime.datetime(1970, 1, 1)
+
+# Stand-ins for None in the binary format
+NO_STRING = 0xFFFFFFFF
+NO_TIME = -(2**63)
+# UTC offset of naive datetimes
+NAIVE = -(2**15)
+
+
+class Codec(ABC):
+    """Interface for encoding an `EventRecord` as a snapshot file"""
+
+    @abstractmethod
+    def encode(self, record: EventRecord) -> bytes:
+        """Returns record in the format of the codec"""
+
+    @abstractmethod
+    def decode(self, data: bytes) -> EventRecord:
+        """Returns the record encoded in data"""
+
+    @abstractmethod
+    def detect(self, data: bytes) -> bool:
+        """Returns True if data (or the start of it) is in the format of the codec"""
+
+
+class JsonCodec(Codec):
+    """A JSON list of events, the format of `EventRecord.save_to_json`"""
+
+    def encode(self, record: EventRecord) -> bytes:
+        data = [event.to_json() for event in record.eventrecord.values()]
+        return json.dumps(data, ensure_ascii=False).encode("utf8")
+
+    def decode(self, data: bytes) -> EventRecord:
+        result = EventRecord()
+        for entry in json.loads(data):
+            result.add_event(Event(**entry))
+        return result
+
+    def detect(self, data: bytes) -> bool:
+        return data.lstrip()[:1] in (b"[", b"")
+
+
+class BinaryCodec(Codec):
+    """
+    A compact binary format with fixed size records sorted by id, so a
+    memory-mapped snapshot can be searched and decoded one event at a time.
+    Datetimes are stored as microseconds since the epoch and the UTC offset
+    in minutes, and titles, places and statuses as indexes into a table of
+    unique strings, so repeated values (ex. statuses) are stored once.
+
+    Layout, little-endian:
+        header: magic, version, number of events, offset of the string table
+        records: id, title, place, status, then (time, offset) for
+            start, end, deadline and signup_start
+        string table: number of strings, the end offset of each string,
+            then the strings in utf8
+    """
+
+    MAGIC = b"ARRS"
+    VERSION = 1
+    HEADER = struct.Struct("<4sHIQ")
+    RECORD = struct.Struct("<qIII" + "qh" * 4)
+
+    def __init__(self):
+        # Timezones by UTC offset in minutes, shared between datetimes
+        self.timezones: dict[int, datetime.timezone] = dict()
+
+    def detect(self, data: bytes) -> bool:
+        return data[:4] == self.MAGIC
+
+    @staticmethod
+    def _encode_time(value: datetime.datetime) -> tuple[int, int]:
+        if value is None:
+            return NO_TIME, 0
+        offset = value.utcoffset()
+        if offset is None:
+            # Naive datetimes are stored as if they were in UTC
+            delta = value - NAIVE_EPOCH
+            minutes = NAIVE
+        else:
+            delta = value - EPOCH
+            minutes = offset.days * 24 * 60 + offset.seconds // 60
+        micros = (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+        return micros, minutes
+
+    def _decode_time(self, micros: int, offset: int) -> datetime.datetime:
+        if micros == NO_TIME:
+            return None
+        if offset == NAIVE:
+            return NAIVE_EPOCH + datetime.timedelta(microseconds=micros)
+
+        timezone = self.timezones.get(offset)
+        if timezone is None:
+            timezone = datetime.timezone(datetime.timedelta(minutes=offset))
+            self.timezones[offset] = timezone
+        seconds, micros = divmod(micros, 1000000)
+        value = datetime.datetime.fromtimestamp(seconds, timezone)
+        return value.replace(microsecond=micros) if micros else value
+
+    def encode(self, record: EventRecord) -> bytes:
+        strings: dict[str, int] = dict()
+
+        def intern(value: str) -> int:
+            if value is None:
+                return NO_STRING
+            return strings.setdefault(value, len(strings))
+
+        records = []
+        for id in sorted(record.eventrecord):
+            event = record.eventrecord[id]
+            times = []
+            for field in ("start", "end", "deadline", "signup_start"):
+                times.extend(self._encode_time(getattr(event, field)))
+            records.append(
+                self.RECORD.pack(
+                    id,
+                    intern(event.title),
+                    intern(event.place),
+                    intern(event.status),
+                    *times,
+                )
+            )
+
+        encoded = [value.encode("utf8") for value in strings]
+        ends = []
+        end = 0
+        for value in encoded:
+            end += len(value)
+            ends.append(end)
+
+        table_offset = self.HEADER.size + self.RECORD.size * len(records)
+        return b"".join(
+            [
+                self.HEADER.pack(self.MAGIC, self.VERSION, len(records), table_offset),
+                *records,
+                struct.pack(f"<I{len(ends)}Q", len(ends), *ends),
+                *encoded,
+            ]
+        )
+
+    def decode(self, data: bytes) -> EventRecord:
+        result = EventRecord()
+        for event in Snapshot(data, self):
+            result.add_event(event)
+        return result
+
+
+class Snapshot:
+    """
+    A binary snapshot where events are decoded when they are accessed.
+    Strings and datetimes are decoded once, on first use, and shared
+    between events. data can be a memory map.
+    """
+
+    def __init__(self, data: bytes, codec: BinaryCodec = None):
+        self.data = data
+        self.codec = codec or BinaryCodec()
+
+        magic, version, self.count, table_offset = BinaryCodec.HEADER.unpack_from(data)
+        if magic != BinaryCodec.MAGIC or version != BinaryCodec.VERSION:
+            raise ValueError(f"Not a snapshot of version {BinaryCodec.VERSION}")
+
+        (string_count,) = struct.unpack_from("<I", data, table_offset)
+        self.string_ends = struct.unpack_from(
+            f"<{string_count}Q", data, table_offset + 4
+        )
+        self.strings_offset = table_offset + 4 + 8 * string_count
+        self.strings: list[str] = [None] * string_count
+        # Decoded datetimes by (time, offset), as many events share times
+        self.times: dict[tuple[int, int], datetime.datetime] = dict()
+
+    def __len__(self):
+        return self.count
+
+    def _string(self, index: int) -> str:
+        if index == NO_STRING:
+            return None
+        value = self.strings[index]
+        if value is None:
+            start = self.string_ends[index - 1] if index else 0
+            end = self.string_ends[index]
+            value = bytes(
+                self.data[self.strings_offset + start : self.strings_offset + end]
+            ).decode("utf8")
+            self.strings[index] = value
+        return value
+
+    def _time(self, micros: int, offset: int) -> datetime.datetime:
+        key = (micros, offset)
+        value = self.times.get(key)
+        if value is None and micros != NO_TIME:
+            value = self.times[key] = self.codec._decode_time(micros, offset)
+        return value
+
+    def _id(self, i: int) -> int:
+        offset = BinaryCodec.HEADER.size + BinaryCodec.RECORD.size * i
+        return struct.unpack_from("<q", self.data, offset)[0]
+
+    def _event(self, values: tuple) -> Event:
+        """Returns the event given the unpacked values of its record"""
+        id, title, place, status, *times = values
+        decode_time = self._time
+        return Event.from_fields(
+            (
+                id,
+                self._string(title),
+                decode_time(times[0], times[1]),
+                decode_time(times[2], times[3]),
+                decode_time(times[4], times[5]),
+                decode_time(times[6], times[7]),
+                self._string(place),
+                self._string(status),
+            )
+        )
+
+    def event_at(self, i: int) -> Event:
+        """Decodes the i-th event, in order of id"""
+        offset = BinaryCodec.HEADER.size + BinaryCodec.RECORD.size * i
+        return self._event(BinaryCodec.RECORD.unpack_from(self.data, offset))
+
+    def get(self, id: int) -> Event:
+        """Finds and decodes the event with the given id, None if there is none"""
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self._id(middle) < id:
+                low = middle + 1
+            else:
+                high = middle
+        if low < self.count and self._id(low) == id:
+            return self.event_at(low)
+        return None
+
+    def __iter__(self) -> Iterator[Event]:
+        start = BinaryCodec.HEADER.size
+        end = start + BinaryCodec.RECORD.size * self.count
+        for values in BinaryCodec.RECORD.iter_unpack(memoryview(self.data)[start:end]):
+            yield self._event(values)
+
+
+# The codecs snapshots can be written with, by name
+CODECS: dict[str, Codec] = {"json": JsonCodec(), "binary": BinaryCodec()}
+
+
+def detect(data: bytes) -> Codec:
+    """Returns the codec of data (or the start of it), None if it is unknown"""
+    for codec in CODECS.values():
+        if codec.detect(data):
+            return codec
+    return None
+
+
+async def save(record: EventRecord, path: str, codec: Codec) -> None:
+    """Saves record to path with codec. The file is replaced atomically"""
+    await write_atomic(path, codec.encode(record))
+
+
+async def load(path: str) -> EventRecord:
+    """
+    Loads the record saved at path, in any of the formats in CODECS.
+    An empty record is returned if there is no file at path.
+    """
+    try:
+        async with aiofiles.open(path, mode="rb") as f:
+            data = await f.read()
+    except FileNotFoundError:
+        logging.warning(f"File not found: {path}")
+        return EventRecord()
+
+    codec = detect(data)
+    if codec is None:
+        raise ValueError(f"Unknown snapshot format in {path}")
+    return codec.decode(data)
+
+
+def open_snapshot(path: str) -> Snapshot:
+    """
+    Memory-maps a binary snapshot, so events are only read from disk and
+    decoded when they are accessed.
+    """
+    with open(path, mode="rb") as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return Snapshot(data)
+
+
+if __name__ == "__main__":
+    # Converts a snapshot between formats:
+    #   python Codec.py <source> <destination> <json|binary>
+    source, destination, name = sys.argv[1:4]
+    record = asyncio.run(load(source))
+    asyncio.run(save(record, destination, CODECS[name]))
+    print(f"Converted {len(record)} events from {source} to {destination} ({name})")
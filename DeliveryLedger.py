@@ -0,0 +1,145 @@
+import logging
+import sqlite3
+import time
+from typing import Iterable, NamedTuple
+
+from SqliteStorage import SqliteDatabase
+
+
+class Notification(NamedTuple):
+    """
+    Identifies a notification about a change to an event. Stamp tells apart
+    repeated changes of the same kind, ex. the new sign up start.
+    """
+
+    event_id: int
+    kind: str
+    stamp: str = ""
+
+
+class DeliveryLedger:
+    """
+    Keeps track of which notifications each user has received, so a retry
+    only sends what is undelivered, and of users that are quarantined because
+    messages to them fail permanently (ex. closed DMs).
+    Everything is kept in memory and written through to SQLite.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS deliveries (
+            user_id INTEGER,
+            event_id INTEGER,
+            kind TEXT,
+            stamp TEXT,
+            delivered_at REAL,
+            PRIMARY KEY (user_id, event_id, kind, stamp)
+        );
+        CREATE INDEX IF NOT EXISTS deliveries_event ON deliveries (event_id);
+        CREATE TABLE IF NOT EXISTS quarantine (
+            user_id INTEGER PRIMARY KEY,
+            reason TEXT,
+            since REAL
+        );
+    """
+
+    def __init__(self, database: SqliteDatabase):
+        self.database = database
+        self.delivered: set[tuple[int, Notification]] = set()
+        self.quarantined: dict[int, str] = dict()
+
+    async def load(self) -> None:
+        """Loads the delivered notifications and quarantined users"""
+
+        def load(connection: sqlite3.Connection) -> tuple[list, list]:
+            deliveries = connection.execute(
+                "SELECT user_id, event_id, kind, stamp FROM deliveries"
+            ).fetchall()
+            quarantined = connection.execute(
+                "SELECT user_id, reason FROM quarantine"
+            ).fetchall()
+            return deliveries, quarantined
+
+        deliveries, quarantined = await self.database.run(load)
+        self.delivered = {
+            (user_id, Notification(event_id, kind, stamp))
+            for user_id, event_id, kind, stamp in deliveries
+        }
+        self.quarantined = dict(quarantined)
+        logging.info(
+            f"Loaded {len(self.delivered)} deliveries and "
+            f"{len(self.quarantined)} quarantined users"
+        )
+
+    def is_delivered(self, user_id: int, notification: Notification) -> bool:
+        return (user_id, notification) in self.delivered
+
+    def is_quarantined(self, user_id: int) -> bool:
+        return user_id in self.quarantined
+
+    async def mark_delivered(
+        self, deliveries: Iterable[tuple[int, Notification]]
+    ) -> None:
+        """Saves the given (user id, notification) pairs as delivered"""
+        deliveries = [d for d in deliveries if d not in self.delivered]
+        if not deliveries:
+            return
+        self.delivered.update(deliveries)
+
+        now = time.time()
+        rows = [(user_id, *notification, now) for user_id, notification in deliveries]
+
+        def insert(connection: sqlite3.Connection) -> None:
+            connection.executemany(
+                "INSERT OR IGNORE INTO deliveries VALUES (?, ?, ?, ?, ?)", rows
+            )
+
+        await self.database.run(insert)
+
+    async def quarantine(self, user_ids: Iterable[int], reason: str) -> None:
+        """Quarantines the given users, they are skipped until released"""
+        user_ids = [id for id in user_ids if id not in self.quarantined]
+        if not user_ids:
+            return
+        for id in user_ids:
+            self.quarantined[id] = reason
+        logging.warning(f"Quarantined users {user_ids}: {reason}")
+
+        now = time.time()
+
+        def insert(connection: sqlite3.Connection) -> None:
+            connection.executemany(
+                "INSERT OR REPLACE INTO quarantine VALUES (?, ?, ?)",
+                [(id, reason, now) for id in user_ids],
+            )
+
+        await self.database.run(insert)
+
+    async def release(self, user_id: int) -> None:
+        """Releases a user from quarantine"""
+        if self.quarantined.pop(user_id, None) is None:
+            return
+        logging.info(f"Released user {user_id} from quarantine")
+
+        def delete(connection: sqlite3.Connection) -> None:
+            connection.execute("DELETE FROM quarantine WHERE user_id = ?", (user_id,))
+
+        await self.database.run(delete)
+
+    async def prune(self, event_ids: Iterable[int]) -> None:
+        """Forgets the deliveries for events not in event_ids"""
+        keep = set(event_ids)
+        pruned = {d for d in self.delivered if d[1].event_id not in keep}
+        if not pruned:
+            return
+        self.delivered -= pruned
+
+        stale = [(id,) for id in {notification.event_id for _, notification in pruned}]
+
+        def delete(connection: sqlite3.Connection) -> None:
+            connection.executemany("DELETE FROM deliveries WHERE event_id = ?", stale)
+
+        await self.database.run(delete)
+        logging.info(f"Pruned {len(pruned)} deliveries")
+
+    async def close(self) -> None:
+        await self.database.close()
@@ -0,0 +1,108 @@
+import logging
+
+from DeliveryLedger import Notification
+from Event import Event
+from EventRecord import Changeset
+from config import SITE_PATH
+
+
+def render_added(event: Event) -> str:
+    """Returns the message about a new event, according to its status"""
+    if event.status == "CLOSED":
+        return (
+            f"Nytt arrangement lagt ut ({event.title}): {SITE_PATH}{event.id}/\n"
+            f"Påmeldingen starter {event.signup_start}."
+        )
+    elif event.status == "ACTIVE":
+        return (
+            f"Nytt arrangement åpnet påmelding ({event.title}): {SITE_PATH}{event.id}/"
+        )
+    elif event.status == "TBA":
+        return (
+            f"Nytt arrangement lagt ut ({event.title}): {SITE_PATH}{event.id}/\n"
+            f"Detaljene er ennå ikke annonsert. Påmelding starter angivelig {event.signup_start}"
+        )
+    elif event.status == "NO_SIGNUP":
+        return (
+            f"Nytt arrangement lagt ut ({event.title}): {SITE_PATH}{event.id}/\n"
+            f"Arrangementet krever ikke påmelding."
+        )
+
+    # No message if event status does not match anything
+    logging.warning(
+        f"Event with id {event.id} does not have a valid status [status: '{event.status}']"
+    )
+    return None
+
+
+def render_opened(event: Event) -> str:
+    return f"Nytt event åpnet påmelding ({event.title}): {SITE_PATH}{event.id}/"
+
+
+def render_signup_changed(event: Event) -> str:
+    return (
+        f"Et event endret når påmeldingen åpner ({event.title}): {SITE_PATH}{event.id}/\n"
+        f"Arrangementet åpner nå påmeldingen {event.signup_start}"
+    )
+
+
+def signup_stamp(event: Event) -> str:
+    """
+    Returns the stamp of a notification about the sign up of event, which is
+    its sign up start, or "" if it has none.
+    """
+    return "" if event.signup_start is None else str(event.signup_start)
+
+
+def render(changes: Changeset) -> list[tuple[Notification, str]]:
+    """
+    Returns the notifications about changes along with their messages.
+    Each message is rendered once, no matter how many users receive it.
+    """
+    result = []
+
+    for event in changes.added.eventrecord.values():
+        message = render_added(event)
+        if message is not None:
+            result.append((Notification(event.id, "added"), message))
+
+    for event in changes.opened.eventrecord.values():
+        notification = Notification(event.id, "opened", signup_stamp(event))
+        result.append((notification, render_opened(event)))
+
+    for event in changes.signup_changed.eventrecord.values():
+        notification = Notification(event.id, "signup_changed", signup_stamp(event))
+        result.append((notification, render_signup_changed(event)))
+
+    return result
+
+
+def pack(
+    rendered: list[tuple[Notification, str]], limit: int
+) -> list[tuple[tuple[Notification, ...], str]]:
+    """
+    Packs rendered notifications into as few messages as possible, keeping
+    their order, where no message is longer than limit characters.
+    Returns each message along with the notifications it contains.
+    """
+    separator = "\n\n"
+    result = []
+    notifications: list[Notification] = []
+    parts: list[str] = []
+    length = 0
+
+    for notification, message in rendered:
+        if len(message) > limit:
+            message = message[: limit - 1] + "…"
+
+        if parts and length + len(separator) + len(message) > limit:
+            result.append((tuple(notifications), separator.join(parts)))
+            notifications, parts, length = [], [], 0
+
+        length += len(message) + (len(separator) if parts else 0)
+        notifications.append(notification)
+        parts.append(message)
+
+    if parts:
+        result.append((tuple(notifications), separator.join(parts)))
+    return result
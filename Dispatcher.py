@@ -0,0 +1,178 @@
+import asyncio
+import logging
+import time
+from collections import deque
+
+import discord
+
+from HelperFunctions import backoff_delay
+from Metrics import SEND_LATENCY, SEND_OUTCOMES
+
+# Outcomes of sending a message
+SENT = "sent"
+FAILED = "failed"
+# The user does not accept messages from the bot (ex. closed DMs)
+REFUSED = "refused"
+
+
+class TokenBucket:
+    """
+    Rate limiter allowing rate acquisitions per second on average,
+    with bursts of up to capacity acquisitions.
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock: asyncio.Lock = None
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self) -> None:
+        """Waits until a token is available and takes it"""
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+
+        # Waiters are served one at a time, in order
+        async with self.lock:
+            self._refill()
+            if self.tokens < 1:
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+                self._refill()
+            self.tokens -= 1
+
+
+class Dispatcher:
+    """
+    Sends direct messages to many users concurrently, limited by a global
+    token bucket and one token bucket per user (each DM channel is its own
+    route in Discord's rate limits).
+    """
+
+    def __init__(
+        self,
+        global_rate: float,
+        route_rate: float,
+        route_burst: int,
+        concurrency: int,
+        max_retries: int,
+    ):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.route_rate = route_rate
+        self.route_burst = route_burst
+        self.route_buckets: dict[int, TokenBucket] = dict()
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self.semaphore: asyncio.Semaphore = None
+
+        # Metrics
+        self.sent = 0
+        self.failed = 0
+        self.retries = 0
+        self.latencies: deque[float] = deque(maxlen=1000)
+        self.last_batch_size = 0
+        self.last_batch_duration = 0.0
+
+    def route_bucket(self, user: discord.abc.User) -> TokenBucket:
+        bucket = self.route_buckets.get(user.id)
+        if bucket is None:
+            bucket = TokenBucket(self.route_rate, self.route_burst)
+            self.route_buckets[user.id] = bucket
+        return bucket
+
+    async def send(self, user: discord.abc.User, message: str) -> str:
+        """
+        Sends message to user, retrying at most max_retries times.
+        Users that do not accept direct messages are not retried.
+        Returns the outcome: SENT, FAILED or REFUSED.
+        """
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.concurrency)
+
+        for attempt in range(self.max_retries + 1):
+            try:
+                # Waiting for the user's route does not take up a send slot
+                await self.route_bucket(user).acquire()
+                async with self.semaphore:
+                    await self.global_bucket.acquire()
+                    t0 = time.monotonic()
+                    await user.send(message)
+                    self.latencies.append(time.monotonic() - t0)
+                    SEND_LATENCY.observe(self.latencies[-1])
+
+                self.sent += 1
+                SEND_OUTCOMES.inc(outcome=SENT)
+                return SENT
+
+            # Not allowed to message the user (ex. closed DMs)
+            except discord.Forbidden as e:
+                logging.warning(f"Not allowed to message user {user}: '{e}'")
+                self.failed += 1
+                SEND_OUTCOMES.inc(outcome=REFUSED)
+                return REFUSED
+
+            except Exception as e:
+                logging.warning(
+                    f"Somethng unexpected happened while messaging user {user}: '{e}' "
+                    f"[attempt: {attempt + 1}]"
+                )
+                SEND_OUTCOMES.inc(outcome="error")
+                if attempt < self.max_retries:
+                    self.retries += 1
+                    await asyncio.sleep(backoff_delay(attempt))
+
+        self.failed += 1
+        SEND_OUTCOMES.inc(outcome=FAILED)
+        return FAILED
+
+    async def send_all(self, jobs: list[tuple[discord.abc.User, str]]) -> list[str]:
+        """
+        Sends every (user, message) pair concurrently.
+        Returns the outcome of each message, in the order of jobs.
+        """
+        t0 = time.monotonic()
+        results = await asyncio.gather(
+            *(self.send(user, message) for user, message in jobs)
+        )
+
+        self.last_batch_size = len(jobs)
+        self.last_batch_duration = time.monotonic() - t0
+        if jobs:
+            logging.info(
+                f"Sent {results.count(SENT)} of {len(jobs)} messages: {self.stats()}"
+            )
+        return results
+
+    def stats(self) -> dict:
+        """
+        Returns the send counters, send latency percentiles and the duration
+        and throughput of the last batch (the time until the last user got
+        their message).
+        """
+        latencies = sorted(self.latencies)
+
+        def percentile(p: float) -> float:
+            if not latencies:
+                return None
+            return latencies[min(len(latencies) - 1, int(p * len(latencies)))]
+
+        return {
+            "sent": self.sent,
+            "failed": self.failed,
+            "retries": self.retries,
+            "latency_p50": percentile(0.5),
+            "latency_p95": percentile(0.95),
+            "latency_max": latencies[-1] if latencies else None,
+            "last_batch_size": self.last_batch_size,
+            "last_batch_duration": self.last_batch_duration,
+            "last_batch_throughput": (
+                self.last_batch_size / self.last_batch_duration
+                if self.last_batch_duration
+                else None
+            ),
+        }
@@ -5,11 +5,54 @@ from typing import Literal
 import aiohttp
 import logging
 
-from HelperFunctions import fetch_json
+from HelperFunctions import FetchError, RequestLimiter, fetch_json
+from ResponseCache import ResponseCache
+from Tracing import span
 from config import API_ENDPOINT
 
 
+def to_datetime(value) -> datetime.datetime:
+    """Converts an iso-string to datetime. None and datetimes are returned as-is"""
+    if value is None or isinstance(value, datetime.datetime):
+        return value
+    return datetime.datetime.fromisoformat(value)
+
+
 class Event:
+    """
+    An immutable event. Use `Event.replace` to get an event with some fields
+    changed. As events are never changed, copies share the same instance.
+    """
+
+    # The fields of an event, in the order of the arguments to __init__
+    FIELDS = (
+        "id",
+        "title",
+        "start",
+        "end",
+        "deadline",
+        "signup_start",
+        "place",
+        "status",
+    )
+    DATETIME_FIELDS = ("start", "end", "deadline", "signup_start")
+
+    # The fields of the api json that `from_api_json` reads
+    API_FIELDS = (
+        "title",
+        "start_date",
+        "end_date",
+        "end_registration_at",
+        "start_registration_at",
+        "location",
+        "expired",
+        "closed",
+        "sign_up",
+        "description",
+    )
+
+    __slots__ = FIELDS + ("_key", "_hash")
+
     def __init__(
         self,
         id: int,
@@ -22,44 +65,104 @@ class Event:
         status: Literal["EXPIRED", "CLOSED", "ACTIVE", "NO_SIGNUP", "TBA"] = None,
     ):
         """
-        Creates a new Event given a set of parameters
+        Creates a new Event given a set of parameters.
+        Dates can be given as iso-strings or as datetimes.
         """
 
         # Sets fields to the input values and converts iso-strings to datetime
-        self.id = id
-        self.title = title
-        self.start = None if start is None else datetime.datetime.fromisoformat(start)
-        self.end = None if end is None else datetime.datetime.fromisoformat(end)
-        self.deadline = (
-            None if deadline is None else datetime.datetime.fromisoformat(deadline)
+        self._set(
+            (
+                id,
+                title,
+                to_datetime(start),
+                to_datetime(end),
+                to_datetime(deadline),
+                to_datetime(signup_start),
+                place,
+                status,
+            )
         )
-        self.signup_start = (
-            None
-            if signup_start is None
-            else datetime.datetime.fromisoformat(signup_start)
+
+    def _set(self, key: tuple) -> None:
+        """Sets every field given a tuple of values in the order of FIELDS"""
+        for field, value in zip(self.FIELDS, key):
+            object.__setattr__(self, field, value)
+        object.__setattr__(self, "_key", key)
+        object.__setattr__(self, "_hash", None)
+
+    def __setattr__(self, name, value):
+        raise AttributeError(
+            f"Event is immutable, use Event.replace to change '{name}'"
         )
-        self.place = place
-        self.status = status
 
-    def to_json(self) -> dict:
-        """Returns a dict representation of an event"""
-        logging.debug(f"Convertet event with id: {self.id}, to dict")
+    def __delattr__(self, name):
+        raise AttributeError(f"Event is immutable, cannot delete '{name}'")
 
-        # Copies dict so to not make changes to the object (mutable)
-        result_json = self.__dict__.copy()
+    def __reduce__(self):
+        return (type(self), self._key)
 
-        # Converts all date fields to a string representation
-        for key, value in result_json.items():
-            if type(value) == datetime.datetime:
-                result_json[key] = value.isoformat()
+    def replace(self, **changes) -> "Event":
+        """
+        Returns a new event with the given fields changed.
+        Unchanged values are shared with self.
+        """
+        for name in self.DATETIME_FIELDS:
+            if name in changes:
+                changes[name] = to_datetime(changes[name])
+
+        key = tuple(
+            changes.pop(field, value) for field, value in zip(self.FIELDS, self._key)
+        )
+        if changes:
+            raise TypeError(f"Event has no fields {list(changes)}")
+        return self.from_fields(key)
+
+    @classmethod
+    def from_fields(cls, key: tuple) -> "Event":
+        """
+        Creates an event given a tuple of values in the order of FIELDS.
+        Dates have to be datetimes (or None), as they are not converted.
+        """
+        result = object.__new__(cls)
+        result._set(key)
+        return result
 
-        return result_json
+    def to_json(self) -> dict:
+        """Returns a dict representation of an event"""
+        return {
+            field: value.isoformat() if isinstance(value, datetime.datetime) else value
+            for field, value in zip(self.FIELDS, self._key)
+        }
 
     @classmethod
-    async def get_event(cls, session: aiohttp.ClientSession, id: int) -> "Event":
+    async def get_event(
+        cls,
+        session: aiohttp.ClientSession,
+        id: int,
+        limiter: RequestLimiter = None,
+        cache: ResponseCache = None,
+    ) -> "Event":
         url = f"{API_ENDPOINT}{id}"
-        event_json = await fetch_json(session, url)
+        try:
+            event_json = await fetch_json(session, url, limiter, cache)
+
+        # The request was rejected (ex. 404). Retries being exhausted is not
+        # handled here, as the event would then look like it lost all its fields.
+        except FetchError as e:
+            if e.status is None:
+                raise e
+            logging.warning(f"The request to event with url {url} failed: '{e}'")
+            return Event(id)
+
+        with span("parse", id=id):
+            return cls.from_api_json(id, event_json, url)
 
+    @classmethod
+    def from_api_json(cls, id: int, event_json: dict, url: str) -> "Event":
+        """
+        Creates an event from the json of an event from the api.
+        Returns Event(id) if the json is bad.
+        """
         # Bad response
         # Event(id) creates an event where id is the value of id and all other fields are set to None
         if len(event_json) == 1:
@@ -105,27 +208,56 @@ class Event:
             place=place,
             status=status,
         )
-        logging.debug(f"Event with id {event.id} retrived")
+        logging.debug("Event with id %s retrived", event.id)
         return event
 
-    def copy(self) -> "Event":
-        """Returns a copy of the instance of `Event`"""
-        logging.debug(f"Copied event with id: {self.id}")
-        return self.__class__(**self.to_json())
+    def changes_status_between(
+        self, since: datetime.datetime, until: datetime.datetime
+    ) -> bool:
+        """
+        Returns True if one of the dates that decide the status of the event
+        (sign up start, deadline, start and end) lies between since and until.
+        Naive datetimes are assumed to be in local time.
+        """
+        for value in (self.signup_start, self.deadline, self.start, self.end):
+            if value is None:
+                continue
+            if value.tzinfo is None:
+                value = value.astimezone()
+            if since < value <= until:
+                return True
+        return False
 
-    def __eq__(self, other: "Event"):
-        return all(
-            self.__dict__[key] == other.__dict__[key] for key in self.__dict__.keys()
+    def changed_fields(self, other: "Event") -> tuple[str, ...]:
+        """Returns the names of the fields that differ between self and other"""
+        if self is other or self._key == other._key:
+            return ()
+        return tuple(
+            field
+            for field, value, other_value in zip(self.FIELDS, self._key, other._key)
+            if value != other_value
         )
 
-    def __repr__(self):
-        logging.debug(f"Returned string representation of event with id: {self.id}")
+    def copy(self) -> "Event":
+        """Returns a copy of the instance of `Event`, which is the instance itself"""
+        return self
+
+    def __eq__(self, other: "Event"):
+        if self is other:
+            return True
+        if not isinstance(other, Event):
+            return NotImplemented
+        return self._key == other._key
 
-        # Gets the json repr of the class (all strings instead of datetime fields)
-        dic = self.to_json()
+    def __hash__(self):
+        # Cached, as events are immutable
+        if self._hash is None:
+            object.__setattr__(self, "_hash", hash(self._key))
+        return self._hash
 
+    def __repr__(self):
         # Formatted as you would call the function
-        return f"{type(self).__name__}({', '.join(f'{key}={value}' for key, value in dic.items())})"
+        return f"{type(self).__name__}({', '.join(f'{key}={value}' for key, value in self.to_json().items())})"
 
 
 if __name__ == "__main__":
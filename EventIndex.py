@@ -0,0 +1,106 @@
+import bisect
+import datetime
+import logging
+from typing import Iterable
+
+from Event import Event
+from EventRecord import EventRecord
+
+# The date fields events are sorted by
+SORTED_FIELDS = ("signup_start", "start", "deadline")
+
+
+class EventIndex:
+    """
+    In-memory indexes over the current events, for answering queries without
+    touching the api or the disk. Events are sorted by each field in
+    SORTED_FIELDS and bucketed by status. The indexes are updated with the
+    changed events of each cycle instead of being rebuilt.
+    """
+
+    def __init__(self):
+        self.events: dict[int, Event] = dict()
+        self.by_status: dict[str, set[int]] = dict()
+
+        # (timestamp, id) sorted by timestamp, for events where the field is set
+        self.sorted: dict[str, list[tuple[float, int]]] = {
+            field: list() for field in SORTED_FIELDS
+        }
+
+    def __len__(self):
+        return len(self.events)
+
+    @classmethod
+    def from_record(cls, record: EventRecord) -> "EventIndex":
+        """Returns an index of the events in record"""
+        result = cls()
+        result.update(record.eventrecord.values())
+        logging.debug(f"Indexed {len(result)} events")
+        return result
+
+    @staticmethod
+    def _entries(event: Event):
+        for field in SORTED_FIELDS:
+            value = getattr(event, field)
+            if value is not None:
+                yield field, (value.timestamp(), event.id)
+
+    def remove(self, id: int) -> None:
+        """Removes the event with the given id"""
+        event = self.events.pop(id, None)
+        if event is None:
+            return
+
+        bucket = self.by_status[event.status]
+        bucket.discard(id)
+        if not bucket:
+            del self.by_status[event.status]
+
+        for field, entry in self._entries(event):
+            entries = self.sorted[field]
+            i = bisect.bisect_left(entries, entry)
+            if i < len(entries) and entries[i] == entry:
+                del entries[i]
+
+    def update(self, events: Iterable[Event]) -> None:
+        """Adds the given events, replacing the previous versions"""
+        for event in events:
+            if self.events.get(event.id) is event:
+                continue
+            self.remove(event.id)
+
+            self.events[event.id] = event
+            self.by_status.setdefault(event.status, set()).add(event.id)
+            for field, entry in self._entries(event):
+                bisect.insort(self.sorted[field], entry)
+
+    def retain(self, ids: Iterable[int]) -> None:
+        """Removes the events whose ids are not in ids"""
+        for id in self.events.keys() - set(ids):
+            self.remove(id)
+
+    def with_status(self, status: str) -> list[Event]:
+        """Returns the events with the given status"""
+        return [self.events[id] for id in self.by_status.get(status, ())]
+
+    def between(
+        self,
+        field: str,
+        after: datetime.datetime,
+        before: datetime.datetime = None,
+        limit: int = None,
+    ) -> list[Event]:
+        """
+        Returns the events where field is in [after, before), ordered by
+        field. At most limit events are returned if limit is given.
+        """
+        entries = self.sorted[field]
+        start = bisect.bisect_left(entries, (after.timestamp(),))
+        end = (
+            len(entries)
+            if before is None
+            else bisect.bisect_left(entries, (before.timestamp(),))
+        )
+        if limit is not None:
+            end = min(end, start + limit)
+        return [self.events[id] for _, id in entries[start:end]]
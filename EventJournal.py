@@ -0,0 +1,108 @@
+import json
+import logging
+import os
+
+import aiofiles
+
+import Codec
+from Event import Event
+from EventRecord import EventRecord
+from HelperFunctions import write_atomic
+from Storage import EventStore
+
+
+class EventJournal(EventStore):
+    """
+    Persists an `EventRecord` as a snapshot and a journal. Each cycle only the
+    changed events are appended to the journal, and the journal is folded into
+    the snapshot by `compact` once it grows long.
+    The snapshot is written with the given codec, and read in any format in
+    `Codec.CODECS`, so changing the codec takes effect on the next compaction.
+    """
+
+    def __init__(
+        self,
+        snapshot_path: str,
+        journal_path: str,
+        compact_every: int,
+        expired_retention: float,
+        codec: Codec.Codec = None,
+    ):
+        """
+        Initializes a journal stored at the given paths. Compaction is due
+        after compact_every appended events, and prunes expired events that
+        ended more than expired_retention seconds ago.
+        Snapshots are written as JSON if codec is not given.
+        """
+        super().__init__(expired_retention)
+        self.snapshot_path = snapshot_path
+        self.journal_path = journal_path
+        self.compact_every = compact_every
+        self.codec = codec or Codec.CODECS["json"]
+
+        # Number of events in the journal
+        self.length = 0
+
+    async def load(self) -> EventRecord:
+        """
+        Loads the snapshot and replays the journal on top of it.
+        A partially written last line (from a crash) is ignored.
+        """
+        result = await Codec.load(self.snapshot_path)
+
+        try:
+            async with aiofiles.open(self.journal_path, mode="r", encoding="utf8") as f:
+                lines = await f.readlines()
+        except FileNotFoundError:
+            lines = []
+
+        self.length = 0
+        for line in lines:
+            try:
+                row = json.loads(line)
+            except ValueError:
+                logging.warning(f"Skipping broken line in {self.journal_path}")
+                continue
+            result.add_event(Event(*row))
+            self.length += 1
+
+        logging.info(
+            f"Loaded {len(result)} events, replayed {self.length} from journal"
+        )
+        return result
+
+    async def append(self, events: dict[int, Event]) -> None:
+        """
+        Appends the given events to the journal, as arrays of their fields
+        """
+        if not events:
+            return
+
+        data = "".join(
+            json.dumps(list(event.to_json().values()), ensure_ascii=False) + "\n"
+            for event in events.values()
+        )
+        async with aiofiles.open(self.journal_path, mode="a", encoding="utf8") as f:
+            await f.write(data)
+            await f.flush()
+            os.fsync(f.fileno())
+
+        self.length += len(events)
+        logging.debug(f"Appended {len(events)} events to the journal")
+
+    def needs_compaction(self) -> bool:
+        """Returns True if the journal is long enough to be compacted"""
+        return self.length >= self.compact_every
+
+    async def compact(self, record: EventRecord) -> None:
+        """
+        Saves record as the new snapshot and empties the journal.
+        Record has to contain every change appended to the journal.
+        """
+        await Codec.save(record, self.snapshot_path, self.codec)
+
+        # Replaying the journal on top of the new snapshot is harmless,
+        # so a crash before it is emptied loses nothing.
+        await write_atomic(self.journal_path, "")
+        self.length = 0
+        logging.info(f"Compacted journal into a snapshot of {len(record)} events")
@@ -1,14 +1,23 @@
 import asyncio
+import datetime
+import hashlib
 import logging
 import sys
 from types import ClassMethodDescriptorType
+from typing import Callable
 import aiohttp
 import json
-import aiofiles
 
-from config import API_ENDPOINT
+from config import (
+    API_ENDPOINT,
+    FULL_REFRESH_INTERVAL,
+    INCREMENTAL_REFRESH,
+    MAX_CONCURRENT_REQUESTS,
+)
 from Event import Event
-from HelperFunctions import fetch_json
+from HelperFunctions import RequestLimiter, fetch_json
+from ResponseCache import ResponseCache
+from Tracing import span
 
 
 class EventRecord:
@@ -21,14 +30,23 @@ class EventRecord:
         """
         self.eventrecord: dict[int, Event] = dict()
 
+        # Fingerprints of the list entries the events were fetched from, and
+        # when the events were fetched. Only set on records from the api.
+        # The fingerprint is None for listed events that have to be fetched
+        # again next time.
+        self.fingerprints: dict[int, str] = dict()
+        self.fetched_at: datetime.datetime = None
+        self.full_refresh_at: datetime.datetime = None
+
     async def save_to_json(self, path: str) -> None:
         """
-        Saves the eventrecord as a list of events to a given path
+        Saves the eventrecord as a list of events to a given path.
+        The file is replaced atomically.
         """
+        # Imported here, as Codec imports EventRecord
+        import Codec
 
-        data = [event.to_json() for event in self.eventrecord.values()]
-        async with aiofiles.open(path, mode="w", encoding="utf8") as f:
-            await f.write(json.dumps(data, ensure_ascii=False))
+        await Codec.save(self, path, Codec.CODECS["json"])
 
     def add_event(self, event: Event):
         """
@@ -53,31 +71,211 @@ class EventRecord:
         """Returns the number of events held in the eventrecord"""
         return len(self.eventrecord)
 
+    @staticmethod
+    def fingerprint(entry: dict) -> str:
+        """
+        Returns a fingerprint of the fields `Event.from_api_json` reads in an
+        entry in the list of events from the api, or None if the entry does
+        not have all of them (the event then has to be fetched to tell if it
+        changed).
+        """
+        if any(field not in entry for field in Event.API_FIELDS):
+            return None
+        fields = {field: entry[field] for field in Event.API_FIELDS}
+        raw = json.dumps(fields, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha1(raw.encode("utf8")).hexdigest()
+
+    def is_unchanged(self, id: int, fingerprint: str, now: datetime.datetime) -> bool:
+        """
+        Returns True if the event with the given id can be carried forward
+        without fetching it again. That is if the list entry has the same
+        fingerprint and the status of the event cannot have changed
+        just by time passing since it was fetched.
+        """
+        if fingerprint is None or self.fingerprints.get(id) != fingerprint:
+            return False
+        return not self.get_event(id).changes_status_between(self.fetched_at, now)
+
     @classmethod
-    async def get_updated(cls):
+    async def get_updated(
+        cls,
+        session: aiohttp.ClientSession = None,
+        cache: ResponseCache = None,
+        previous: "EventRecord" = None,
+    ):
         """
-        Gets an updated record of all events from the api endpoint
+        Gets an updated record of all events from the api endpoint.
+        At most MAX_CONCURRENT_REQUESTS requests are in flight at the same time.
+        A short lived session is used if no session is given.
+        Responses are revalidated against the cache if a cache is given.
+
+        If INCREMENTAL_REFRESH is set and a previous record from the api is
+        given, only events that are new or changed since previous are fetched.
+        The rest is carried forward from previous. A full refresh is still
+        done every FULL_REFRESH_INTERVAL.
         """
-        url = API_ENDPOINT
+        if session is None:
+            async with aiohttp.ClientSession() as session:
+                return await cls.get_updated(session, cache, previous)
+
+        limiter = RequestLimiter(MAX_CONCURRENT_REQUESTS)
+        now = datetime.datetime.now(datetime.timezone.utc)
+
+        incremental = (
+            INCREMENTAL_REFRESH
+            and previous is not None
+            and previous.full_refresh_at is not None
+            and (now - previous.full_refresh_at).total_seconds() < FULL_REFRESH_INTERVAL
+        )
 
-        async with aiohttp.ClientSession() as session:
+        result = cls()
+        result.fetched_at = now
+        result.full_refresh_at = previous.full_refresh_at if incremental else now
+
+        # Ids are handed from the list reader to the detail workers through a
+        # bounded queue, so details are fetched while the next page is read.
+        queue: asyncio.Queue = asyncio.Queue(maxsize=2 * MAX_CONCURRENT_REQUESTS)
+        fetched: dict[int, Event] = dict()
+        errors: list[Exception] = list()
+
+        async def worker():
+            while True:
+                id = await queue.get()
+                if id is None:
+                    return
+
+                # Keeps draining the queue after a failure so the reader never blocks
+                if errors:
+                    continue
+                try:
+                    with span("get_event", id=id):
+                        fetched[id] = await Event.get_event(session, id, limiter, cache)
+                except Exception as e:
+                    errors.append(e)
+
+        workers = [
+            asyncio.create_task(worker()) for _ in range(MAX_CONCURRENT_REQUESTS)
+        ]
+        try:
+            # Ids in the order of the list from the api
+            order: list[int] = list()
+            fingerprints: dict[int, str] = dict()
+
+            async for entry in cls.iter_list(session, limiter, cache):
+                try:
+                    id = entry["id"]
+                # Bad JSON
+                except KeyError as e:
+                    logging.critical(
+                        f"Something was from with an event in the list from the "
+                        f"api [url: {API_ENDPOINT}]. KeyError: '{e}'"
+                    )
+                    raise e
+
+                if id in fingerprints:
+                    continue
+                order.append(id)
+                fingerprints[id] = cls.fingerprint(entry)
+
+                if not (
+                    incremental and previous.is_unchanged(id, fingerprints[id], now)
+                ):
+                    await queue.put(id)
+
+            for _ in workers:
+                await queue.put(None)
+            await asyncio.gather(*workers)
+
+        finally:
+            for task in workers:
+                task.cancel()
+
+        if errors:
+            raise errors[0]
+
+        for id in order:
+            event = fetched[id] if id in fetched else previous.get_event(id)
+
+            # Events from a bad response have no fields. They are kept as they
+            # were in previous, or left out if they are new, and fetched again
+            # next time.
+            if event.status is None:
+                if previous is not None and id in previous.eventrecord:
+                    result.add_event(previous.get_event(id))
+                    result.fingerprints[id] = None
+                continue
+
+            result.add_event(event)
+            result.fingerprints[id] = fingerprints[id]
+
+        logging.debug(
+            f"Fetched {len(fetched)} of {len(result)} events "
+            f"[incremental: {incremental}]"
+        )
+        return result
+
+    @classmethod
+    async def get_refreshed(
+        cls,
+        previous: "EventRecord",
+        ids: set[int],
+        session: aiohttp.ClientSession = None,
+        cache: ResponseCache = None,
+    ) -> "EventRecord":
+        """
+        Returns a copy of previous where only the events with the given ids
+        are fetched again from the api, without reading the list of events.
+        Events from a bad response are kept as they were in previous.
+        """
+        if session is None:
+            async with aiohttp.ClientSession() as session:
+                return await cls.get_refreshed(previous, ids, session, cache)
+
+        limiter = RequestLimiter(MAX_CONCURRENT_REQUESTS)
+        fetched = await asyncio.gather(
+            *(
+                Event.get_event(session, id, limiter, cache)
+                for id in ids
+                if id in previous.eventrecord
+            )
+        )
 
-            # Gets all the events from the api
-            events_json = await fetch_json(session, url)
+        # The list of events was not read, so the fingerprints and fetch times
+        # of previous still hold for the next incremental refresh
+        result = cls()
+        result.eventrecord = dict(previous.eventrecord)
+        result.fingerprints = previous.fingerprints
+        result.fetched_at = previous.fetched_at
+        result.full_refresh_at = previous.full_refresh_at
+        for event in fetched:
+            if event.status is not None:
+                result.add_event(event)
+
+        logging.debug(f"Refreshed events {[event.id for event in fetched]}")
+        return result
 
-            result = cls()
-            # Tries to retrive the ids of the events and then finds each event
-            # given the id.
-            try:
-                results: dict[str, any] = events_json["results"]
-                event_ids: list[int] = [event["id"] for event in results]
+    @staticmethod
+    async def iter_list(
+        session: aiohttp.ClientSession,
+        limiter: RequestLimiter = None,
+        cache: ResponseCache = None,
+    ):
+        """
+        Yields the entries in the list of events from the api endpoint,
+        following the "next" link of each page. A page is only requested
+        once the entries of the previous page have been consumed.
+        """
+        url = API_ENDPOINT
+        seen: set[str] = set()
 
-                # Gets every event for every event_id async
-                events = await asyncio.gather(
-                    *(Event.get_event(session, event_id) for event_id in event_ids)
-                )
-                result.eventrecord = {event.id: event for event in events}
+        while url is not None and url not in seen:
+            seen.add(url)
+            with span("list_page", url=url):
+                events_json = await fetch_json(session, url, limiter, cache)
 
+            # Tries to retrive the events in the page
+            try:
+                results: list[dict] = events_json["results"]
             # Bad JSON
             except KeyError as e:
                 logging.critical(
@@ -86,32 +284,21 @@ class EventRecord:
                 )
                 raise e
 
-        return result
+            for entry in results:
+                yield entry
+
+            url = events_json.get("next")
 
     @classmethod
-    async def from_json(cls, path: str) -> None:
+    async def from_json(cls, path: str) -> "EventRecord":
         """
         Creates a new EventRecord given a path to a json.
         The json should be a list of json-representations of events.
+        An empty EventRecord is returned if the file is not found.
         """
-        result = cls()
-
-        try:
-            # Gets a list of JSON represented events.
-            async with aiofiles.open(path, mode="r", encoding="utf8") as f:
-                raw = await f.read()
-            data = json.loads(raw)
-
-            # Unpacks the kwargs from the json.
-            for entry in data:
-                result.add_event(Event(**entry))
-
-        # The resulting EventRecord stays empty if file is not found
-        # (empty EventRecord is then returned)
-        except FileNotFoundError:
-            logging.warning(f"File not found: {path}")
+        import Codec
 
-        return result
+        return await Codec.load(path)
 
     @staticmethod
     def shared_ids(
@@ -126,6 +313,51 @@ class EventRecord:
             eventrecord2.eventrecord.keys()
         )
 
+    @classmethod
+    def diff(cls, old: "EventRecord", new: "EventRecord") -> "Changeset":
+        """
+        Compares old and new in a single pass and returns a `Changeset`
+        holding the added, removed and changed events, along with the events
+        of each kind in `CHANGE_DETECTORS`.
+        """
+        changeset = Changeset(old, new)
+
+        for id, new_event in new.eventrecord.items():
+            old_event = old.eventrecord.get(id)
+            if old_event is None:
+                changeset.added.add_event(new_event)
+                continue
+
+            # Events carried forward by an incremental refresh
+            if old_event is new_event:
+                continue
+
+            fields = new_event.changed_fields(old_event)
+            if not fields:
+                continue
+
+            changeset.changed[id] = fields
+            for kind, detector in CHANGE_DETECTORS.items():
+                if detector(old_event, new_event):
+                    changeset.kinds[kind].add_event(new_event)
+
+        # Only looks for events missing from new if there are any
+        if len(new) - len(changeset.added) != len(old):
+            for id, old_event in old.eventrecord.items():
+                if id in new.eventrecord:
+                    continue
+
+                # Events missing from new are kept as "EXPIRED"
+                if old_event.status == "EXPIRED":
+                    changeset.removed.add_event(old_event)
+                else:
+                    event = old_event.replace(status="EXPIRED")
+                    changeset.removed.add_event(event)
+                    changeset.kinds["expired"].add_event(event)
+
+        logging.debug(f"Diff: {changeset}")
+        return changeset
+
     @classmethod
     def get_newly_opened_events(
         cls, old: "EventRecord", new: "EventRecord"
@@ -135,21 +367,7 @@ class EventRecord:
         containing the events where events in old changed to
         "ACTIVE" in new.
         """
-
-        shared_ids = cls.shared_ids(old, new)
-
-        # Checks common ids for changes
-        newly_opened = cls()
-        for id in shared_ids:
-            # If the event switched from anything but "ACTIVE" to "ACTIVE"
-            if (
-                old.get_event(id).status != "ACTIVE"
-                and new.get_event(id).status == "ACTIVE"
-            ):
-                newly_opened.add_event(new.get_event(id).copy())
-
-        logging.debug(f"Found {len(newly_opened)} newly opened events")
-        return newly_opened
+        return cls.diff(old, new).opened
 
     @classmethod
     def get_new_events(cls, old: "EventRecord", new: "EventRecord") -> "EventRecord":
@@ -157,17 +375,7 @@ class EventRecord:
         Returns a new `EventRecord` that contains all the events
         that are unique to new.
         """
-        shared_ids = cls.shared_ids(old, new)
-
-        result = cls()
-
-        # All ids in new, but not in old (unique to new)
-        new_ids = [id for id in new.eventrecord.keys() if id not in shared_ids]
-        for id in new_ids:
-            result.add_event(new.get_event(id).copy())
-
-        logging.debug(f"Found {len(result)} new events")
-        return result
+        return cls.diff(old, new).added
 
     @classmethod
     def get_new_signup_start(
@@ -177,13 +385,7 @@ class EventRecord:
         Returns a new `EventRecord` that contains all the events
         in new where the sign up start changed
         """
-        shared_ids = cls.shared_ids(old, new)
-
-        result = cls()
-        for id in shared_ids:
-            if old.get_event(id).signup_start != new.get_event(id).signup_start:
-                result.add_event(new.get_event(id).copy())
-        return result
+        return cls.diff(old, new).signup_changed
 
     @classmethod
     def combine(cls, old: "EventRecord", new: "EventRecord") -> "EventRecord":
@@ -191,21 +393,95 @@ class EventRecord:
         Returns an updated EventRecord. Using an old `EventRecord` and a new `EventRecord`.
         All the events in old not in new is changed to expired and all the events in new is returned "as-is"
         """
-        shared_ids = cls.shared_ids(old, new)
+        return cls.diff(old, new).combine()
+
+
+# Kinds of changes to an event present in both records of a diff.
+# Each detector is given the old and the new version of an event
+# that changed, and returns True if the change is of its kind.
+CHANGE_DETECTORS: dict[str, Callable[[Event, Event], bool]] = {
+    "opened": lambda old, new: old.status != "ACTIVE" and new.status == "ACTIVE",
+    "signup_changed": lambda old, new: old.signup_start != new.signup_start,
+    "expired": lambda old, new: old.status != "EXPIRED" and new.status == "EXPIRED",
+}
+
+
+class Changeset:
+    """The changes from one `EventRecord` to another, as found by `EventRecord.diff`"""
+
+    def __init__(self, old: EventRecord, new: EventRecord):
+        """
+        Initializes an empty changeset between old and new
+        """
+        self.old = old
+        self.new = new
+
+        # Events unique to new
+        self.added = EventRecord()
+
+        # Events unique to old, set to "EXPIRED"
+        self.removed = EventRecord()
+
+        # The names of the fields that changed, by id, for events in both
+        self.changed: dict[int, tuple[str, ...]] = dict()
+
+        # The events of each kind in CHANGE_DETECTORS, as they are in new
+        # (or removed for "expired")
+        self.kinds: dict[str, EventRecord] = {
+            kind: EventRecord() for kind in CHANGE_DETECTORS
+        }
+
+    @property
+    def opened(self) -> EventRecord:
+        """Events that changed to "ACTIVE" """
+        return self.kinds["opened"]
+
+    @property
+    def signup_changed(self) -> EventRecord:
+        """Events where the sign up start changed"""
+        return self.kinds["signup_changed"]
 
-        combined = cls()
+    @property
+    def expired(self) -> EventRecord:
+        """Events that changed to "EXPIRED", or that are no longer listed"""
+        return self.kinds["expired"]
 
-        # All events in old that are not in new, gets set to "EXPIRED"
-        for id in old.eventrecord.keys():
-            if id not in shared_ids:
-                event = old.get_event(id).copy()
-                event.status = "EXPIRED"
-                combined.add_event(event)
+    def __bool__(self):
+        """Returns True if there are any changes"""
+        return bool(self.added.eventrecord or self.changed or self.expired.eventrecord)
 
-        # All events in new added as-is
-        for event in new.eventrecord.values():
-            combined.add_event(event.copy())
+    def __str__(self):
+        counts = {kind: len(record) for kind, record in self.kinds.items()}
+        return (
+            f"added: {len(self.added)}, changed: {len(self.changed)}, "
+            f"removed: {len(self.removed)}, {counts}"
+        )
+
+    def updated(self) -> dict[int, Event]:
+        """
+        Returns the events that differ between old and the combined record,
+        as they are in the combined record.
+        """
+        result = dict(self.added.eventrecord)
+        for id in self.changed:
+            result[id] = self.new.eventrecord[id]
+        for id, event in self.removed.eventrecord.items():
+            if event is not self.old.eventrecord[id]:
+                result[id] = event
+        return result
+
+    def combine(self) -> EventRecord:
+        """
+        Returns the updated `EventRecord`: the removed events followed by
+        the events in new as-is. The events are shared, not copied.
+        """
+        combined = EventRecord()
+        combined.eventrecord.update(self.removed.eventrecord)
+        combined.eventrecord.update(self.new.eventrecord)
 
+        combined.fingerprints = self.new.fingerprints
+        combined.fetched_at = self.new.fetched_at
+        combined.full_refresh_at = self.new.full_refresh_at
         return combined
 
 
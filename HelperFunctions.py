@@ -1,21 +1,219 @@
 import logging
+import random
 import aiohttp
 import asyncio
+import email.utils
+import datetime
+import json
+import os
+import time
+import aiofiles
+from typing import Union
+
+from Metrics import FETCH_LATENCY, HTTP_RESPONSES, HTTP_RETRIES, url_label
+from ResponseCache import ResponseCache
+
+from config import (
+    BACKOFF_BASE,
+    BACKOFF_MAX,
+    MAX_RETRIES,
+    REQUEST_TIMEOUT,
+    RETRY_AFTER_MAX,
+)
+
+# Status codes that are worth retrying. Every other non-200 status is
+# treated as a permanent failure for the given url.
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class FetchError(Exception):
+    """Raised when a json could not be retrived from an url"""
+
+    def __init__(self, url: str, status: int = None, message: str = ""):
+        self.url = url
+        self.status = status
+        super().__init__(f"{message} [url: {url}, status: {status}]")
+
+
+async def write_atomic(path: str, data: Union[str, bytes]) -> None:
+    """
+    Writes data to a given path by writing a temporary file and renaming it,
+    so the file at path is either the old or the new version, never a partial one.
+    Strings are written as utf8 and bytes as they are.
+    """
+    tmp_path = f"{path}.tmp"
+    if isinstance(data, bytes):
+        opened = aiofiles.open(tmp_path, mode="wb")
+    else:
+        opened = aiofiles.open(tmp_path, mode="w", encoding="utf8")
+    async with opened as f:
+        await f.write(data)
+        await f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+class RequestLimiter:
+    """
+    Limits the number of requests in flight to an api, and pauses all of
+    them when the server asks to wait with a Retry-After header.
+    """
+
+    def __init__(self, concurrency: int):
+        self.semaphore = asyncio.Semaphore(concurrency)
+        # No request is sent before this time (time.monotonic)
+        self.not_before = 0.0
+
+    def pause(self, seconds: float) -> None:
+        """Holds back every request for the given number of seconds"""
+        self.not_before = max(self.not_before, time.monotonic() + seconds)
+
+    def wait_time(self) -> float:
+        """Returns the number of seconds until requests may be sent again"""
+        return max(0.0, self.not_before - time.monotonic())
+
+    async def acquire(self) -> None:
+        while True:
+            await asyncio.sleep(self.wait_time())
+            await self.semaphore.acquire()
+            # Paused while waiting for a slot
+            if self.wait_time() == 0:
+                return
+            self.semaphore.release()
+
+    def release(self) -> None:
+        self.semaphore.release()
+
+
+def connector_stats(connector: aiohttp.TCPConnector) -> dict:
+    """
+    Returns a dict describing the state of the connection pool of a connector
+    """
+    return {
+        "limit": connector.limit,
+        "limit_per_host": connector.limit_per_host,
+        "idle": sum(len(conns) for conns in getattr(connector, "_conns", {}).values()),
+        "in_use": len(getattr(connector, "_acquired", ())),
+        "closed": connector.closed,
+    }
+
+
+def backoff_delay(attempt: int) -> float:
+    """
+    Returns the time to wait before retry number `attempt` (starting at 0).
+    Uses exponential backoff with full jitter, capped by BACKOFF_MAX.
+    """
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2**attempt))
+
+
+def parse_retry_after(value: str) -> float:
+    """
+    Returns the number of seconds to wait given the value of a Retry-After header.
+    The header is either a number of seconds or a HTTP-date. Returns None if the
+    value could not be parsed.
+    """
+    if value is None:
+        return None
+
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    now = datetime.datetime.now(datetime.timezone.utc)
+    return max(0.0, (retry_at - now).total_seconds())
 
 
 async def fetch_json(
-    session: aiohttp.ClientSession, url: str
-) -> aiohttp.ClientResponse:
+    session: aiohttp.ClientSession,
+    url: str,
+    limiter: RequestLimiter = None,
+    cache: ResponseCache = None,
+) -> dict:
     """
-    Retrives a json from a an api given the url
+    Retrives a json from a an api given the url.
+
+    At most MAX_RETRIES retries are made on timeouts, connection errors and
+    retryable status codes, waiting with exponential backoff between each.
+    A Retry-After header from the server is honoured in full when present,
+    and gives up if it is longer than RETRY_AFTER_MAX.
+    If a limiter is given, a slot is held while the request is in flight,
+    but not while waiting to retry. A Retry-After pauses every request
+    made through the limiter.
+    If a cache is given, the request is made conditional on the cached
+    validators and the cached json is returned on "304 Not Modified".
+    Raises `FetchError` if the json could not be retrived.
     """
-    async with session.get(url) as r:
-        if r.status != 200:
+    timeout = aiohttp.ClientTimeout(total=REQUEST_TIMEOUT)
+
+    for attempt in range(MAX_RETRIES + 1):
+        retry_after = None
+        if limiter is not None and limiter.wait_time() > RETRY_AFTER_MAX:
+            raise FetchError(url, message="The server asked to wait too long")
+        try:
+            if limiter is not None:
+                await limiter.acquire()
+            try:
+                t0 = time.monotonic()
+                headers = {} if cache is None else cache.validators(url)
+                async with session.get(url, headers=headers, timeout=timeout) as r:
+                    HTTP_RESPONSES.inc(status=r.status)
+                    if r.status == 200:
+                        if cache is None:
+                            return await r.json()
+
+                        body = await r.read()
+                        data = json.loads(body)
+                        await cache.store(url, body, data, r.headers)
+                        return data
+
+                    if r.status == 304 and cache is not None:
+                        data = await cache.get(url)
+                        if data is not None:
+                            return data
+
+                        # The cached body is gone, retrying without validators
+                        continue
+
+                    if r.status not in RETRY_STATUSES:
+                        raise FetchError(url, r.status, "Request failed")
+
+                    logging.warning(
+                        f"The request to {r.url} did not return with a response code for OK [200] "
+                        f"[status: {r.status}, attempt: {attempt + 1}]"
+                    )
+                    retry_after = parse_retry_after(r.headers.get("Retry-After"))
+            finally:
+                FETCH_LATENCY.observe(time.monotonic() - t0, url=url_label(url))
+                if limiter is not None:
+                    limiter.release()
+
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            HTTP_RESPONSES.inc(status="error")
             logging.warning(
-                f"The request to {r.url} did not return with a response code for OK [200]"
+                f"The request to {url} failed: '{e!r}' [attempt: {attempt + 1}]"
             )
-            # Retrying
-            await asyncio.sleep(0.5)
-            return await fetch_json(session, id)
+
+        # No retries left
+        if attempt == MAX_RETRIES:
+            break
+
+        # Waits before retrying, as long as the server asked if it did
+        if retry_after is None:
+            delay = backoff_delay(attempt)
         else:
-            return await r.json()
+            delay = retry_after
+            if limiter is not None:
+                limiter.pause(retry_after)
+            if retry_after > RETRY_AFTER_MAX:
+                raise FetchError(
+                    url, message=f"The server asked to wait {retry_after:.0f} seconds"
+                )
+        HTTP_RETRIES.inc()
+        await asyncio.sleep(delay)
+
+    raise FetchError(url, message=f"Gave up after {MAX_RETRIES + 1} attempts")
@@ -0,0 +1,176 @@
+import bisect
+import logging
+import re
+from typing import Iterable
+
+from aiohttp import web
+
+# Default histogram buckets, in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+def _labels(names: tuple[str, ...], values: tuple[str, ...], extra: str = "") -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    """A counter for each combination of label values"""
+
+    def __init__(self, name: str, help: str, labels: Iterable[str] = ()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values: dict[tuple[str, ...], float] = dict()
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = tuple(str(labels[name]) for name in self.labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for key, value in sorted(self.values.items()):
+            lines.append(f"{self.name}{_labels(self.labels, key)} {value}")
+        return lines
+
+
+class Histogram:
+    """Counts of observed values in cumulative buckets, for each combination of label values"""
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labels: Iterable[str] = (),
+        buckets: Iterable[float] = BUCKETS,
+    ):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(sorted(buckets))
+
+        # Per label values: the count in each bucket (not cumulative, with
+        # one more for +Inf), the sum and the count of the observed values
+        self.values: dict[tuple[str, ...], list] = dict()
+
+    def observe(self, value: float, **labels) -> None:
+        key = tuple(str(labels[name]) for name in self.labels)
+        counts = self.values.get(key)
+        if counts is None:
+            counts = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+
+        counts[0][bisect.bisect_left(self.buckets, value)] += 1
+        counts[1] += value
+        counts[2] += 1
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for key, (buckets, total, count) in sorted(self.values.items()):
+            cumulative = 0
+            for bound, bucket in zip(self.buckets + ("+Inf",), buckets):
+                cumulative += bucket
+                le = _labels(self.labels, key, f'le="{bound}"')
+                lines.append(f"{self.name}_bucket{le} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labels, key)} {total}")
+            lines.append(f"{self.name}_count{_labels(self.labels, key)} {count}")
+        return lines
+
+
+def url_label(url: str) -> str:
+    """
+    Returns the url without its query, and with numeric path segments
+    replaced by "{id}", so each endpoint of the api is one label value.
+    """
+    path = url.split("?", 1)[0]
+    return re.sub(r"/\d+(?=/|$)", "/{id}", path)
+
+
+CYCLE_DURATION = Histogram(
+    "arrangementer_cycle_seconds",
+    "Duration of a polling cycle",
+    ["mode"],
+)
+FETCH_LATENCY = Histogram(
+    "arrangementer_fetch_seconds",
+    "Latency of each request to the api",
+    ["url"],
+)
+HTTP_RESPONSES = Counter(
+    "arrangementer_http_responses_total",
+    "Responses from the api by status code, or 'error' for failed requests",
+    ["status"],
+)
+HTTP_RETRIES = Counter(
+    "arrangementer_http_retries_total",
+    "Retried requests to the api",
+)
+EVENT_CHANGES = Counter(
+    "arrangementer_event_changes_total",
+    "Changed events found by each diff, by kind of change",
+    ["kind"],
+)
+SEND_LATENCY = Histogram(
+    "arrangementer_send_seconds",
+    "Latency of sending a direct message",
+)
+SEND_OUTCOMES = Counter(
+    "arrangementer_send_total",
+    "Messages by outcome, and 'error' for each failed attempt",
+    ["outcome"],
+)
+SIGNUP_TO_NOTIFY = Histogram(
+    "arrangementer_signup_to_notification_seconds",
+    "Time from sign up opening to the notification being sent",
+    buckets=(1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800),
+)
+OUTBOX_WAIT = Histogram(
+    "arrangementer_outbox_wait_seconds",
+    "Time from a notification being enqueued to being sent",
+)
+
+METRICS = (
+    CYCLE_DURATION,
+    FETCH_LATENCY,
+    HTTP_RESPONSES,
+    HTTP_RETRIES,
+    EVENT_CHANGES,
+    SEND_LATENCY,
+    SEND_OUTCOMES,
+    SIGNUP_TO_NOTIFY,
+    OUTBOX_WAIT,
+)
+
+
+def render() -> str:
+    """Returns every metric in the Prometheus text format"""
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+class MetricsServer:
+    """Serves the metrics in the Prometheus text format on /metrics"""
+
+    def __init__(self, host: str, port: int):
+        self.host = host
+        self.port = port
+        self.runner: web.AppRunner = None
+
+    async def handle(self, request: web.Request) -> web.Response:
+        return web.Response(text=render(), content_type="text/plain")
+
+    async def start(self) -> None:
+        app = web.Application()
+        app.router.add_get("/metrics", self.handle)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, self.host, self.port).start()
+        logging.info(f"Serving metrics on http://{self.host}:{self.port}/metrics")
+
+    async def close(self) -> None:
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
@@ -0,0 +1,239 @@
+import asyncio
+import logging
+import random
+import sqlite3
+import time
+from typing import Iterable, NamedTuple
+
+from DeliveryLedger import Notification
+from SqliteStorage import SqliteDatabase
+
+
+class OutboxEntry(NamedTuple):
+    """A notification waiting in the outbox to be sent to a user"""
+
+    user_id: int
+    notification: Notification
+    message: str
+    created_at: float
+    attempts: int
+
+
+class Outbox:
+    """
+    A durable queue of notifications to send, stored in SQLite. The poller
+    enqueues notifications and a separate consumer drains them, so slow
+    delivery never holds back polling, and undelivered notifications
+    survive restarts. Each message is stored once, no matter how many users
+    it is queued for.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS messages (
+            event_id INTEGER,
+            kind TEXT,
+            stamp TEXT,
+            message TEXT,
+            PRIMARY KEY (event_id, kind, stamp)
+        );
+        CREATE TABLE IF NOT EXISTS outbox (
+            user_id INTEGER,
+            event_id INTEGER,
+            kind TEXT,
+            stamp TEXT,
+            created_at REAL,
+            attempts INTEGER DEFAULT 0,
+            next_attempt_at REAL,
+            PRIMARY KEY (user_id, event_id, kind, stamp)
+        );
+        CREATE INDEX IF NOT EXISTS outbox_next_attempt ON outbox (next_attempt_at);
+        CREATE INDEX IF NOT EXISTS outbox_created ON outbox (created_at);
+    """
+
+    def __init__(
+        self,
+        database: SqliteDatabase,
+        retry_base: float,
+        retry_max: float,
+        max_attempts: int,
+    ):
+        """
+        Failed entries are retried with exponential backoff starting at
+        retry_base seconds and capped by retry_max, at most max_attempts times.
+        """
+        self.database = database
+        self.retry_base = retry_base
+        self.retry_max = retry_max
+        self.max_attempts = max_attempts
+        self.wakeup: asyncio.Event = None
+
+    def _notify(self) -> None:
+        if self.wakeup is not None:
+            self.wakeup.set()
+
+    async def wait(self, timeout: float = None) -> None:
+        """
+        Waits until something is enqueued, or at most timeout seconds
+        (forever if timeout is None).
+        """
+        if self.wakeup is None:
+            self.wakeup = asyncio.Event()
+        try:
+            await asyncio.wait_for(self.wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        self.wakeup.clear()
+
+    async def enqueue(
+        self,
+        rendered: list[tuple[Notification, str]],
+        entries: Iterable[tuple[int, Notification]],
+    ) -> None:
+        """
+        Saves the rendered messages and enqueues each (user id, notification)
+        in entries. Entries already in the outbox are left as they are.
+        """
+        now = time.time()
+        messages = [(*notification, message) for notification, message in rendered]
+        rows = [(user_id, *notification, now, now) for user_id, notification in entries]
+
+        def insert(connection: sqlite3.Connection) -> None:
+            connection.executemany(
+                "INSERT OR REPLACE INTO messages VALUES (?, ?, ?, ?)", messages
+            )
+            connection.executemany(
+                "INSERT OR IGNORE INTO outbox "
+                "(user_id, event_id, kind, stamp, created_at, next_attempt_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+
+        await self.database.run(insert)
+        logging.debug(f"Enqueued {len(rows)} notifications")
+        self._notify()
+
+    async def ready(self, created_before: float, limit: int) -> list[OutboxEntry]:
+        """
+        Returns at most limit entries that are due and were created before
+        created_before, oldest first.
+        """
+        now = time.time()
+
+        def select(connection: sqlite3.Connection) -> list[tuple]:
+            return connection.execute(
+                "SELECT o.user_id, o.event_id, o.kind, o.stamp, m.message, "
+                "o.created_at, o.attempts "
+                "FROM outbox o JOIN messages m "
+                "ON o.event_id = m.event_id AND o.kind = m.kind AND o.stamp = m.stamp "
+                "WHERE o.next_attempt_at <= ? AND o.created_at <= ? "
+                "ORDER BY o.created_at LIMIT ?",
+                (now, created_before, limit),
+            ).fetchall()
+
+        rows = await self.database.run(select)
+        return [
+            OutboxEntry(user_id, Notification(event_id, kind, stamp), *rest)
+            for user_id, event_id, kind, stamp, *rest in rows
+        ]
+
+    async def remove(self, entries: Iterable[tuple[int, Notification]]) -> None:
+        """Removes the given (user id, notification) entries"""
+        rows = [(user_id, *notification) for user_id, notification in entries]
+        if not rows:
+            return
+
+        def delete(connection: sqlite3.Connection) -> None:
+            connection.executemany(
+                "DELETE FROM outbox "
+                "WHERE user_id = ? AND event_id = ? AND kind = ? AND stamp = ?",
+                rows,
+            )
+
+        await self.database.run(delete)
+
+    async def remove_users(self, user_ids: Iterable[int]) -> None:
+        """Removes every entry for the given users"""
+        rows = [(user_id,) for user_id in user_ids]
+        if not rows:
+            return
+
+        def delete(connection: sqlite3.Connection) -> None:
+            connection.executemany("DELETE FROM outbox WHERE user_id = ?", rows)
+
+        await self.database.run(delete)
+
+    async def postpone(
+        self, entries: Iterable[OutboxEntry]
+    ) -> list[tuple[int, Notification]]:
+        """
+        Schedules failed entries to be retried with backoff.
+        Returns the (user id, notification) of the entries that ran out of
+        attempts, those entries are left for the caller to remove.
+        """
+        now = time.time()
+        rows = []
+        exhausted = []
+        for entry in entries:
+            attempts = entry.attempts + 1
+            if attempts >= self.max_attempts:
+                exhausted.append((entry.user_id, entry.notification))
+                continue
+
+            # Waits at least half of the backoff, so retries are never immediate
+            delay = min(self.retry_max, self.retry_base * 2**attempts)
+            delay = random.uniform(delay / 2, delay)
+            rows.append((attempts, now + delay, entry.user_id, *entry.notification))
+
+        def update(connection: sqlite3.Connection) -> None:
+            connection.executemany(
+                "UPDATE outbox SET attempts = ?, next_attempt_at = ? "
+                "WHERE user_id = ? AND event_id = ? AND kind = ? AND stamp = ?",
+                rows,
+            )
+
+        if rows:
+            await self.database.run(update)
+        return exhausted
+
+    async def next_due(self, hold: float) -> float:
+        """
+        Returns the time the next entry is due, given that entries are held
+        back hold seconds after they are created. None if the outbox is empty.
+        """
+
+        def select(connection: sqlite3.Connection) -> float:
+            return connection.execute(
+                "SELECT MIN(MAX(next_attempt_at, created_at + ?)) FROM outbox",
+                (hold,),
+            ).fetchone()[0]
+
+        return await self.database.run(select)
+
+    async def prune_messages(self) -> None:
+        """Deletes the messages that are no longer queued for any user"""
+
+        def delete(connection: sqlite3.Connection) -> None:
+            connection.execute(
+                "DELETE FROM messages WHERE NOT EXISTS (SELECT 1 FROM outbox o "
+                "WHERE o.event_id = messages.event_id AND o.kind = messages.kind "
+                "AND o.stamp = messages.stamp)"
+            )
+
+        await self.database.run(delete)
+
+    async def stats(self) -> dict:
+        """Returns the number of entries in the outbox and the age of the oldest"""
+
+        def select(connection: sqlite3.Connection) -> tuple[int, float]:
+            return connection.execute(
+                "SELECT COUNT(*), MIN(created_at) FROM outbox"
+            ).fetchone()
+
+        depth, oldest = await self.database.run(select)
+        return {
+            "depth": depth,
+            "oldest_age": None if oldest is None else time.time() - oldest,
+        }
+
+    async def close(self) -> None:
+        await self.database.close()
@@ -0,0 +1,43 @@
+import logging
+
+
+class PollInterval:
+    """
+    The interval between polls of the api, adapted to how much is happening.
+    The interval drops to the minimum when a poll finds changes, and backs
+    off exponentially towards the maximum while nothing changes. It is also
+    kept short while sign ups are about to open.
+    """
+
+    def __init__(
+        self, initial: float, minimum: float, maximum: float, backoff: float = 2
+    ):
+        """
+        Initializes the interval at initial seconds, kept between minimum
+        and maximum. Each poll without changes multiplies it by backoff.
+        """
+        self.minimum = minimum
+        self.maximum = maximum
+        self.backoff = backoff
+        self.interval = min(maximum, max(minimum, initial))
+
+    def update(self, changed: bool, upcoming: int = 0) -> float:
+        """
+        Returns the interval until the next poll, given whether the last poll
+        found changes and the number of sign ups opening soon.
+        Each upcoming sign up halves the longest allowed interval.
+        """
+        if changed:
+            self.interval = self.minimum
+        else:
+            self.interval = min(self.maximum, self.interval * self.backoff)
+
+        if upcoming:
+            limit = max(self.minimum, self.maximum / 2**upcoming)
+            self.interval = min(self.interval, limit)
+
+        logging.debug(
+            f"Next poll in {self.interval} seconds "
+            f"[changed: {changed}, upcoming sign ups: {upcoming}]"
+        )
+        return self.interval
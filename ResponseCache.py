@@ -0,0 +1,175 @@
+import hashlib
+import json
+import logging
+import os
+from collections import OrderedDict
+
+import aiofiles
+
+
+class ResponseCache:
+    """
+    Holds json responses on disk together with their validators (ETag and
+    Last-Modified), so that unchanged responses can be revalidated with a
+    conditional request instead of being downloaded and parsed again.
+    The least recently used responses are evicted when the total size of the
+    stored bodies exceeds max_bytes.
+    """
+
+    INDEX_FILE = "index.json"
+
+    def __init__(self, directory: str, max_bytes: int):
+        """
+        Initializes a new empty cache stored in the given directory.
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+        # url -> {"file": str, "etag": str, "last_modified": str, "size": int}
+        # Ordered from least to most recently used.
+        self.entries: "OrderedDict[str, dict]" = OrderedDict()
+
+        # Parsed bodies that have been read during this run, by url
+        self.data: dict[str, any] = dict()
+
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @classmethod
+    async def load(cls, directory: str, max_bytes: int) -> "ResponseCache":
+        """
+        Loads the cache index from the given directory.
+        An empty cache is returned if no index is found.
+        """
+        result = cls(directory, max_bytes)
+        os.makedirs(directory, exist_ok=True)
+
+        try:
+            async with aiofiles.open(result.index_path, mode="r", encoding="utf8") as f:
+                raw = await f.read()
+            for url, entry in json.loads(raw):
+                result.entries[url] = entry
+                result.size += entry["size"]
+
+        except FileNotFoundError:
+            logging.info(f"No response cache index found in {directory}")
+        except (ValueError, KeyError, TypeError) as e:
+            logging.warning(f"Discarding corrupt response cache index: '{e}'")
+            result.entries.clear()
+            result.size = 0
+
+        result.evict()
+        return result
+
+    @property
+    def index_path(self) -> str:
+        return os.path.join(self.directory, self.INDEX_FILE)
+
+    def validators(self, url: str) -> dict[str, str]:
+        """
+        Returns the headers for a conditional request for the given url.
+        The dict is empty if the url is not cached.
+        """
+        entry = self.entries.get(url)
+        if entry is None:
+            return {}
+
+        headers = {}
+        if entry["etag"] is not None:
+            headers["If-None-Match"] = entry["etag"]
+        if entry["last_modified"] is not None:
+            headers["If-Modified-Since"] = entry["last_modified"]
+        return headers
+
+    async def get(self, url: str) -> any:
+        """
+        Returns the cached json for the given url after a "304 Not Modified".
+        Returns None if the body could not be found.
+        """
+        entry = self.entries.get(url)
+        if entry is None:
+            return None
+
+        if url not in self.data:
+            try:
+                path = os.path.join(self.directory, entry["file"])
+                async with aiofiles.open(path, mode="rb") as f:
+                    self.data[url] = json.loads(await f.read())
+            except (FileNotFoundError, ValueError) as e:
+                logging.warning(f"Cached body for {url} could not be read: '{e}'")
+                self.invalidate(url)
+                return None
+
+        self.entries.move_to_end(url)
+        self.hits += 1
+        return self.data[url]
+
+    async def store(self, url: str, body: bytes, data: any, headers) -> None:
+        """
+        Stores the body and parsed json of a response for the given url.
+        Responses without an ETag or a Last-Modified header are not stored.
+        """
+        self.misses += 1
+
+        etag = headers.get("ETag")
+        last_modified = headers.get("Last-Modified")
+        if etag is None and last_modified is None:
+            return
+
+        self.invalidate(url)
+        file = f"{hashlib.sha1(url.encode('utf8')).hexdigest()}.json"
+        async with aiofiles.open(os.path.join(self.directory, file), mode="wb") as f:
+            await f.write(body)
+
+        self.entries[url] = {
+            "file": file,
+            "etag": etag,
+            "last_modified": last_modified,
+            "size": len(body),
+        }
+        self.data[url] = data
+        self.size += len(body)
+        self.evict()
+
+    def invalidate(self, url: str) -> None:
+        """
+        Removes an url from the cache. The body is left on disk until it is
+        overwritten, as the index is what decides what is cached.
+        """
+        entry = self.entries.pop(url, None)
+        if entry is not None:
+            self.size -= entry["size"]
+        self.data.pop(url, None)
+
+    def evict(self) -> None:
+        """Evicts the least recently used entries until the cache fits in max_bytes"""
+        while self.size > self.max_bytes and self.entries:
+            url, entry = self.entries.popitem(last=False)
+            self.size -= entry["size"]
+            self.data.pop(url, None)
+            self.evictions += 1
+
+            try:
+                os.remove(os.path.join(self.directory, entry["file"]))
+            except FileNotFoundError:
+                pass
+
+    async def save_index(self) -> None:
+        """
+        Saves the index of cached urls and validators, in LRU order.
+        """
+        data = list(self.entries.items())
+        async with aiofiles.open(self.index_path, mode="w", encoding="utf8") as f:
+            await f.write(json.dumps(data, ensure_ascii=False))
+
+    def stats(self) -> dict:
+        """Returns the hit and miss counters along with the size of the cache"""
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "entries": len(self.entries),
+            "bytes": self.size,
+        }
@@ -0,0 +1,211 @@
+import asyncio
+import json
+import logging
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
+
+from Event import Event
+from EventRecord import EventRecord
+from Storage import EventStore, UserStore
+
+
+class SqliteDatabase:
+    """
+    A SQLite connection in WAL mode. Every query runs on a single worker
+    thread, so the event loop is never blocked and queries never overlap.
+    """
+
+    def __init__(self, path: str, schema: str):
+        """
+        Opens the database at path and creates the tables in schema
+        if they do not exist.
+        """
+        self.path = path
+        self.schema = schema
+        self.connection: sqlite3.Connection = None
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.closed = False
+
+    def _connect(self) -> sqlite3.Connection:
+        if self.connection is None:
+            self.connection = sqlite3.connect(self.path, check_same_thread=False)
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("PRAGMA synchronous=NORMAL")
+            self.connection.executescript(self.schema)
+        return self.connection
+
+    async def run(self, function: Callable[[sqlite3.Connection], any]) -> any:
+        """
+        Runs function with the connection on the worker thread.
+        Everything function does is one transaction.
+        """
+
+        def transaction():
+            connection = self._connect()
+            with connection:
+                return function(connection)
+
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, transaction)
+
+    async def close(self) -> None:
+        """Closes the connection. Stores sharing the database may all call this"""
+        if self.closed:
+            return
+        self.closed = True
+
+        def close():
+            if self.connection is not None:
+                self.connection.close()
+                self.connection = None
+
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self.executor, close)
+        self.executor.shutdown(wait=False)
+
+
+# The columns of the events table that hold the fields of an event
+# (quoted, as "end" is a keyword)
+EVENT_COLUMNS = ", ".join(f'"{field}"' for field in Event.FIELDS)
+
+
+class SqliteEventStore(EventStore):
+    """
+    Stores events in a SQLite table with an index on status, used to find
+    expired events when pruning. The table is only read whole on startup,
+    queries are answered from the record in memory.
+    Dates are stored as iso-strings, to keep their offset.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS events (
+            id INTEGER PRIMARY KEY,
+            title TEXT,
+            start TEXT,
+            "end" TEXT,
+            deadline TEXT,
+            signup_start TEXT,
+            place TEXT,
+            status TEXT
+        );
+        CREATE INDEX IF NOT EXISTS events_status ON events (status);
+        DROP INDEX IF EXISTS events_signup_start;
+    """
+
+    def __init__(
+        self, database: SqliteDatabase, compact_every: int, expired_retention: float
+    ):
+        """
+        Initializes a store in the given database. Pruning is due after
+        compact_every saved events.
+        """
+        super().__init__(expired_retention)
+        self.database = database
+        self.compact_every = compact_every
+        self.appended = 0
+
+    @staticmethod
+    def _row(event: Event) -> tuple:
+        return tuple(event.to_json().values())
+
+    async def load(self) -> EventRecord:
+        def load(connection: sqlite3.Connection) -> list[tuple]:
+            return connection.execute(f"SELECT {EVENT_COLUMNS} FROM events").fetchall()
+
+        result = EventRecord()
+        for row in await self.database.run(load):
+            result.add_event(Event(*row))
+
+        logging.info(f"Loaded {len(result)} events from {self.database.path}")
+        return result
+
+    async def append(self, events: dict[int, Event]) -> None:
+        if not events:
+            return
+
+        rows = [self._row(event) for event in events.values()]
+        placeholders = ", ".join("?" for _ in rows[0])
+
+        def upsert(connection: sqlite3.Connection) -> None:
+            connection.executemany(
+                f"INSERT OR REPLACE INTO events ({EVENT_COLUMNS}) "
+                f"VALUES ({placeholders})",
+                rows,
+            )
+
+        await self.database.run(upsert)
+        self.appended += len(rows)
+        logging.debug(f"Saved {len(rows)} events to {self.database.path}")
+
+    def needs_compaction(self) -> bool:
+        return self.appended >= self.compact_every
+
+    async def compact(self, record: EventRecord) -> None:
+        """Deletes the expired events that are no longer in record"""
+
+        def delete(connection: sqlite3.Connection) -> int:
+            expired = connection.execute(
+                "SELECT id FROM events WHERE status = 'EXPIRED'"
+            ).fetchall()
+            pruned = [(id,) for id, in expired if id not in record.eventrecord]
+            connection.executemany("DELETE FROM events WHERE id = ?", pruned)
+            return len(pruned)
+
+        deleted = await self.database.run(delete)
+        self.appended = 0
+        logging.info(f"Deleted {deleted} pruned events from {self.database.path}")
+
+    async def close(self) -> None:
+        await self.database.close()
+
+
+class SqliteUserStore(UserStore):
+    """Stores the users in a SQLite table keyed by user id"""
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY,
+            added_at REAL,
+            metadata TEXT
+        );
+    """
+
+    def __init__(self, database: SqliteDatabase):
+        self.database = database
+
+    async def load(self) -> dict[int, dict]:
+        def load(connection: sqlite3.Connection) -> list[tuple]:
+            # Tables from before metadata was stored
+            columns = [row[1] for row in connection.execute("PRAGMA table_info(users)")]
+            if "metadata" not in columns:
+                connection.execute("ALTER TABLE users ADD COLUMN metadata TEXT")
+            return connection.execute("SELECT id, metadata FROM users").fetchall()
+
+        return {
+            id: json.loads(metadata) if metadata else {}
+            for id, metadata in await self.database.run(load)
+        }
+
+    async def update(self, added: dict[int, dict], removed: set[int]) -> None:
+        now = time.time()
+        rows = [
+            (id, now, json.dumps(metadata, ensure_ascii=False))
+            for id, metadata in added.items()
+        ]
+
+        def update(connection: sqlite3.Connection) -> None:
+            connection.executemany(
+                "INSERT INTO users (id, added_at, metadata) VALUES (?, ?, ?) "
+                "ON CONFLICT (id) DO UPDATE SET metadata = excluded.metadata",
+                rows,
+            )
+            connection.executemany(
+                "DELETE FROM users WHERE id = ?", [(id,) for id in removed]
+            )
+
+        await self.database.run(update)
+
+    async def close(self) -> None:
+        await self.database.close()
@@ -0,0 +1,125 @@
+import datetime
+import json
+import logging
+from abc import ABC, abstractmethod
+
+import aiofiles
+
+from Event import Event
+from EventRecord import EventRecord
+from HelperFunctions import write_atomic
+
+
+class EventStore(ABC):
+    """
+    Interface for persisting an `EventRecord`. The record is loaded once at
+    startup, and after that only the changed events of each cycle are saved.
+    """
+
+    def __init__(self, expired_retention: float):
+        """
+        Expired events that ended more than expired_retention seconds ago
+        are pruned by `prune`.
+        """
+        self.expired_retention = expired_retention
+
+    @abstractmethod
+    async def load(self) -> EventRecord:
+        """Loads the saved EventRecord"""
+
+    @abstractmethod
+    async def append(self, events: dict[int, Event]) -> None:
+        """Saves the given changed events"""
+
+    def needs_compaction(self) -> bool:
+        """Returns True if `prune` and `compact` should be run"""
+        return False
+
+    @abstractmethod
+    async def compact(self, record: EventRecord) -> None:
+        """
+        Makes the saved record equal to record, which is the current record
+        after `prune`. Record has to contain every change given to `append`.
+        """
+
+    async def close(self) -> None:
+        """Releases any resources held by the store"""
+
+    def prune(self, record: EventRecord) -> EventRecord:
+        """
+        Returns record without the events that are "EXPIRED", no longer listed
+        by the api and ended more than expired_retention seconds ago.
+        Events without an end or start date are kept.
+        """
+        now = datetime.datetime.now(datetime.timezone.utc)
+        limit = now - datetime.timedelta(seconds=self.expired_retention)
+
+        result = EventRecord()
+        result.fingerprints = record.fingerprints
+        result.fetched_at = record.fetched_at
+        result.full_refresh_at = record.full_refresh_at
+
+        for id, event in record.eventrecord.items():
+            ended = event.end or event.start
+            if (
+                event.status == "EXPIRED"
+                and id not in record.fingerprints
+                and ended is not None
+                and (ended if ended.tzinfo else ended.astimezone()) < limit
+            ):
+                continue
+            result.add_event(event)
+
+        logging.info(f"Pruned {len(record) - len(result)} expired events")
+        return result
+
+
+class UserStore(ABC):
+    """
+    Interface for persisting the registered users, as their ids along with
+    cached metadata about each user (ex. their name), so users do not have to
+    be fetched from Discord at startup.
+    """
+
+    @abstractmethod
+    async def load(self) -> dict[int, dict]:
+        """Loads the saved users, as metadata by user id"""
+
+    @abstractmethod
+    async def update(self, added: dict[int, dict], removed: set[int]) -> None:
+        """Saves the given added (or changed) users and removed user ids"""
+
+    async def close(self) -> None:
+        """Releases any resources held by the store"""
+
+
+class JsonUserStore(UserStore):
+    """
+    Stores the users as an object of metadata by user id in a JSON file.
+    The old format, a list of user ids, is also accepted.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.users: dict[int, dict] = dict()
+
+    async def load(self) -> dict[int, dict]:
+        try:
+            async with aiofiles.open(self.path, mode="r", encoding="utf8") as f:
+                data = json.loads(await f.read())
+        except FileNotFoundError:
+            data = {}
+
+        if isinstance(data, list):
+            self.users = {int(id): {} for id in data}
+        else:
+            self.users = {int(id): metadata for id, metadata in data.items()}
+        return dict(self.users)
+
+    async def update(self, added: dict[int, dict], removed: set[int]) -> None:
+        self.users.update(added)
+        for id in removed:
+            self.users.pop(id, None)
+        await write_atomic(
+            self.path, json.dumps(self.users, ensure_ascii=False, sort_keys=True)
+        )
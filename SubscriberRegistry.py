@@ -0,0 +1,91 @@
+import logging
+from typing import Iterator
+
+from Storage import UserStore
+from WriteBehind import WriteBehind
+
+
+class SubscriberRegistry:
+    """
+    The registered users by id, with their cached metadata. Changes are saved
+    to the user store in the background, where a burst of changes is
+    coalesced into a single write.
+    """
+
+    def __init__(self, store: UserStore, delay: float = 0):
+        """
+        Initializes an empty registry saved to store. Writes wait delay
+        seconds after the first change, to let more changes coalesce.
+        """
+        self.store = store
+        self.users: dict[int, dict] = dict()
+        self.writer = WriteBehind(self.write, delay=delay, merge=self.merge)
+
+    async def load(self) -> None:
+        """Loads the users from the store and starts saving changes in the background"""
+        self.users = await self.store.load()
+        self.writer.start()
+        logging.info(f"Loaded {len(self.users)} end users")
+
+    def __contains__(self, user_id: int) -> bool:
+        return user_id in self.users
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self.users)
+
+    def __len__(self):
+        return len(self.users)
+
+    def get(self, user_id: int) -> dict:
+        """Returns the metadata of the user, None if not registered"""
+        return self.users.get(user_id)
+
+    def add(self, user_id: int, metadata: dict) -> bool:
+        """
+        Registers the user, or updates the metadata of a registered user.
+        Returns True if the user was not registered before.
+        """
+        new = user_id not in self.users
+        if self.users.get(user_id) != metadata:
+            self.users[user_id] = metadata
+            self.writer.schedule(({user_id: metadata}, set()))
+        return new
+
+    def remove(self, user_id: int) -> bool:
+        """Unregisters the user. Returns True if the user was registered"""
+        if user_id not in self.users:
+            return False
+        del self.users[user_id]
+        self.writer.schedule((dict(), {user_id}))
+        return True
+
+    @property
+    def dirty(self) -> bool:
+        """True if there are changes that are not saved yet"""
+        return self.writer.dirty
+
+    @staticmethod
+    def merge(
+        pending: tuple[dict[int, dict], set[int]], new: tuple[dict[int, dict], set[int]]
+    ) -> tuple[dict[int, dict], set[int]]:
+        """Combines two (added, removed) changes, where new is the latest"""
+        added, removed = pending
+        new_added, new_removed = new
+        added = {
+            id: metadata for id, metadata in added.items() if id not in new_removed
+        }
+        added.update(new_added)
+        return added, (removed - new_added.keys()) | new_removed
+
+    async def write(self, changes: tuple[dict[int, dict], set[int]]) -> None:
+        added, removed = changes
+        await self.store.update(added, removed)
+        logging.debug(f"Saved {len(added)} added and {len(removed)} removed users")
+
+    async def flush(self) -> None:
+        """Saves the pending changes right away"""
+        await self.writer.flush()
+
+    async def close(self) -> None:
+        """Stops saving in the background and saves the pending changes"""
+        await self.writer.close()
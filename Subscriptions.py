@@ -0,0 +1,205 @@
+import re
+from typing import NamedTuple
+
+from Event import Event
+
+# Kinds of notifications users can subscribe to, by the name used in commands
+KIND_NAMES = {"nye": "added", "åpnet": "opened", "endret": "signup_changed"}
+
+
+def tokenize(text: str) -> set[str]:
+    """Returns the lowercase words in text"""
+    if not text:
+        return set()
+    return set(re.findall(r"\w+", text.lower()))
+
+
+class Subscription(NamedTuple):
+    """
+    What a user wants to be notified about. An event matches if it matches
+    every part that is set: any of the words in its title, any of the words
+    in its place, any of the kinds of notifications, and the start of the
+    event within the hours [from, to). Empty parts match everything.
+    """
+
+    words: frozenset = frozenset()
+    places: frozenset = frozenset()
+    kinds: frozenset = frozenset()
+    hours: tuple[int, int] = None
+
+    def is_empty(self) -> bool:
+        return not (self.words or self.places or self.kinds or self.hours)
+
+    def matches_hours(self, event: Event) -> bool:
+        if self.hours is None:
+            return True
+        if event.start is None:
+            return False
+        start, end = self.hours
+        if start <= end:
+            return start <= event.start.hour < end
+        # Windows past midnight, ex. 22-02
+        return event.start.hour >= start or event.start.hour < end
+
+    def to_json(self) -> dict:
+        return {
+            "words": sorted(self.words),
+            "places": sorted(self.places),
+            "kinds": sorted(self.kinds),
+            "hours": list(self.hours) if self.hours else None,
+        }
+
+    @classmethod
+    def from_json(cls, data: dict) -> "Subscription":
+        if not data:
+            return cls()
+        return cls(
+            frozenset(data.get("words", ())),
+            frozenset(data.get("places", ())),
+            frozenset(data.get("kinds", ())),
+            tuple(data["hours"]) if data.get("hours") else None,
+        )
+
+    def describe(self) -> str:
+        """Returns the subscription as shown to the user"""
+        if self.is_empty():
+            return "Du får varsler om alle arrangementer."
+        kinds = {kind: name for name, kind in KIND_NAMES.items()}
+        lines = []
+        if self.words:
+            lines.append(f"Ord i tittelen: {', '.join(sorted(self.words))}")
+        if self.places:
+            lines.append(f"Sted: {', '.join(sorted(self.places))}")
+        if self.kinds:
+            lines.append(f"Type: {', '.join(sorted(kinds[k] for k in self.kinds))}")
+        if self.hours:
+            lines.append(f"Starter mellom kl. {self.hours[0]} og {self.hours[1]}")
+        return "\n".join(lines)
+
+    def parse(self, args: list[str]) -> "Subscription":
+        """
+        Returns the subscription changed by the arguments of a filter command:
+        "ord <words>", "sted <words>", "type <nye|åpnet|endret>",
+        "tid <from>-<to>" or "fjern". A part is cleared if no values are given.
+        Raises ValueError for bad arguments.
+        """
+        if not args:
+            raise ValueError("Mangler hva som skal filtreres")
+        part, values = args[0].lower(), [value.lower() for value in args[1:]]
+
+        if part == "fjern":
+            return Subscription()
+        if part == "ord":
+            return self._replace(words=frozenset(tokenize(" ".join(values))))
+        if part == "sted":
+            return self._replace(places=frozenset(tokenize(" ".join(values))))
+        if part == "type":
+            unknown = [value for value in values if value not in KIND_NAMES]
+            if unknown:
+                raise ValueError(f"Ukjent type: {', '.join(unknown)}")
+            return self._replace(kinds=frozenset(KIND_NAMES[v] for v in values))
+        if part == "tid":
+            if not values:
+                return self._replace(hours=None)
+            match = re.fullmatch(r"(\d{1,2})-(\d{1,2})", values[0])
+            if match is None or not all(0 <= int(h) <= 24 for h in match.groups()):
+                raise ValueError("Tid må skrives som fra-til, ex. 16-20")
+            return self._replace(hours=(int(match[1]), int(match[2])))
+
+        raise ValueError(f"Ukjent filter: {part}")
+
+
+class SubscriptionIndex:
+    """
+    Finds the users subscribed to a notification about an event through
+    inverted indexes from title words, place words and kinds to users.
+    Each user is counted once per part of their subscription the event
+    matches, so only the users with a matching word, place or kind are
+    looked at, along with the users that filter on none of them.
+    """
+
+    def __init__(self):
+        self.subscriptions: dict[int, Subscription] = dict()
+
+        self.words: dict[str, set[int]] = dict()
+        self.places: dict[str, set[int]] = dict()
+        self.kinds: dict[str, set[int]] = dict()
+
+        # Users that do not filter on words, places or kinds,
+        # without and with filtering on hours
+        self.unfiltered: set[int] = set()
+        self.unfiltered_hours: set[int] = set()
+
+    def __len__(self):
+        return len(self.subscriptions)
+
+    def get(self, user_id: int) -> Subscription:
+        return self.subscriptions.get(user_id)
+
+    @staticmethod
+    def _parts(subscription: Subscription) -> list[tuple[str, frozenset]]:
+        return [
+            ("words", subscription.words),
+            ("places", subscription.places),
+            ("kinds", subscription.kinds),
+        ]
+
+    def update(self, user_id: int, subscription: Subscription) -> None:
+        """Adds the user to the index, replacing any previous subscription"""
+        self.remove(user_id)
+        self.subscriptions[user_id] = subscription
+
+        indexed = False
+        for name, keys in self._parts(subscription):
+            index = getattr(self, name)
+            for key in keys:
+                index.setdefault(key, set()).add(user_id)
+            indexed = indexed or bool(keys)
+        if not indexed and subscription.hours is None:
+            self.unfiltered.add(user_id)
+        elif not indexed:
+            self.unfiltered_hours.add(user_id)
+
+    def remove(self, user_id: int) -> None:
+        """Removes the user from the index"""
+        subscription = self.subscriptions.pop(user_id, None)
+        if subscription is None:
+            return
+
+        self.unfiltered.discard(user_id)
+        self.unfiltered_hours.discard(user_id)
+        for name, keys in self._parts(subscription):
+            index = getattr(self, name)
+            for key in keys:
+                users = index[key]
+                users.discard(user_id)
+                if not users:
+                    del index[key]
+
+    def match(self, event: Event, kind: str) -> set[int]:
+        """Returns the ids of the users subscribed to a notification of kind about event"""
+        counts: dict[int, int] = dict()
+        for index, keys in (
+            (self.words, tokenize(event.title)),
+            (self.places, tokenize(event.place)),
+            (self.kinds, (kind,)),
+        ):
+            # Users are counted once per part, even if several keys match
+            matched = set()
+            for key in keys:
+                matched |= index.get(key, set())
+            for user_id in matched:
+                counts[user_id] = counts.get(user_id, 0) + 1
+
+        result = set()
+        for user_id, count in counts.items():
+            subscription = self.subscriptions[user_id]
+            required = sum(1 for _, keys in self._parts(subscription) if keys)
+            if count == required and subscription.matches_hours(event):
+                result.add(user_id)
+
+        result |= self.unfiltered
+        for user_id in self.unfiltered_hours:
+            if self.subscriptions[user_id].matches_hours(event):
+                result.add(user_id)
+        return result
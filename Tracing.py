@@ -0,0 +1,127 @@
+import contextlib
+import contextvars
+import cProfile
+import io
+import json
+import logging
+import os
+import pstats
+import time
+import tracemalloc
+
+# Spans are written as JSON lines through this logger, which has no
+# handlers (and spans are not recorded) until `export_spans` is called
+span_logger = logging.getLogger("spans")
+span_logger.propagate = False
+
+# The span that is running in the current task, if any
+current_span: contextvars.ContextVar["Span"] = contextvars.ContextVar(
+    "current_span", default=None
+)
+
+
+class Span:
+    """A timed stage of a cycle. Spans started inside a span become its children"""
+
+    __slots__ = ("name", "trace_id", "span_id", "parent_id", "start", "attributes")
+
+    def __init__(self, name: str, parent: "Span", attributes: dict):
+        self.name = name
+        self.span_id = os.urandom(8).hex()
+        self.trace_id = parent.trace_id if parent else os.urandom(16).hex()
+        self.parent_id = parent.span_id if parent else None
+        self.start = time.time()
+        self.attributes = attributes
+
+    def set(self, **attributes) -> None:
+        """Adds attributes to the span"""
+        self.attributes.update(attributes)
+
+
+def export_spans(path: str) -> None:
+    """Starts recording spans, appended as JSON lines to the file at path"""
+    handler = logging.FileHandler(path, encoding="utf8")
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    span_logger.addHandler(handler)
+    span_logger.setLevel(logging.INFO)
+
+
+@contextlib.contextmanager
+def span(name: str, **attributes):
+    """
+    Times the body of the with-statement as a span with the given name and
+    attributes, and exports it when the body exits. Yields the span, or None
+    if spans are not recorded.
+    """
+    if not span_logger.handlers:
+        yield None
+        return
+
+    parent = current_span.get()
+    result = Span(name, parent, attributes)
+    token = current_span.set(result)
+    error = None
+    try:
+        yield result
+    except BaseException as e:
+        error = repr(e)
+        raise
+    finally:
+        current_span.reset(token)
+        record = {
+            "name": result.name,
+            "trace_id": result.trace_id,
+            "span_id": result.span_id,
+            "parent_id": result.parent_id,
+            "start": result.start,
+            "duration": time.time() - result.start,
+            "attributes": result.attributes,
+        }
+        if error is not None:
+            record["error"] = error
+        span_logger.info(json.dumps(record, ensure_ascii=False, default=str))
+
+
+@contextlib.contextmanager
+def profile(mode: str, path: str):
+    """
+    Profiles the body of the with-statement, and dumps the stats to files
+    starting with path. mode is "cprofile" for where the time goes, or
+    "tracemalloc" for where memory was allocated and kept.
+    Everything running in the meantime is profiled, not just the body.
+    """
+    if mode == "cprofile":
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            profiler.dump_stats(f"{path}.prof")
+            summary = io.StringIO()
+            stats = pstats.Stats(profiler, stream=summary)
+            stats.sort_stats("cumulative").print_stats(50)
+            with open(f"{path}.cprofile.txt", "w", encoding="utf8") as f:
+                f.write(summary.getvalue())
+            logging.info(f"Wrote cProfile stats to {path}.prof")
+
+    elif mode == "tracemalloc":
+        started = not tracemalloc.is_tracing()
+        if started:
+            tracemalloc.start(10)
+        before = tracemalloc.take_snapshot()
+        try:
+            yield
+        finally:
+            after = tracemalloc.take_snapshot()
+            _, peak = tracemalloc.get_traced_memory()
+            if started:
+                tracemalloc.stop()
+            lines = [f"Peak traced memory: {peak} bytes", ""]
+            lines += [str(stat) for stat in after.compare_to(before, "lineno")[:50]]
+            with open(f"{path}.tracemalloc.txt", "w", encoding="utf8") as f:
+                f.write("\n".join(lines))
+            logging.info(f"Wrote tracemalloc stats to {path}.tracemalloc.txt")
+
+    else:
+        raise ValueError(f"Unknown profiling mode '{mode}'")
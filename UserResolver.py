@@ -0,0 +1,75 @@
+import asyncio
+import logging
+from collections import OrderedDict
+
+import discord
+
+
+class UserResolver:
+    """
+    Resolves user ids to `discord.User` objects when they are needed, instead
+    of fetching every user at startup. Resolved users are kept in an LRU
+    cache, and at most concurrency users are fetched from the api at a time.
+    """
+
+    def __init__(self, client: discord.Client, concurrency: int, cache_size: int):
+        self.client = client
+        self.concurrency = concurrency
+        self.cache_size = cache_size
+        self.cache: OrderedDict[int, discord.User] = OrderedDict()
+        self.semaphore: asyncio.Semaphore = None
+
+        # Metrics
+        self.hits = 0
+        self.fetches = 0
+
+    def remember(self, user: discord.User) -> None:
+        """Caches a user object that is already at hand, ex. the author of a message"""
+        self.cache[user.id] = user
+        self.cache.move_to_end(user.id)
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+    def forget(self, user_id: int) -> None:
+        self.cache.pop(user_id, None)
+
+    async def resolve(self, user_id: int) -> discord.User:
+        """
+        Returns the user with the given id, None if the user does not exist.
+        Other errors from the api are raised.
+        """
+        user = self.cache.get(user_id)
+        if user is not None:
+            self.cache.move_to_end(user_id)
+            self.hits += 1
+            return user
+
+        # Users the client has seen are known without a request
+        user = self.client.get_user(user_id)
+        if user is None:
+            if self.semaphore is None:
+                self.semaphore = asyncio.Semaphore(self.concurrency)
+            async with self.semaphore:
+                try:
+                    self.fetches += 1
+                    user = await self.client.fetch_user(user_id)
+                except discord.NotFound:
+                    logging.warning(f"User with id {user_id} does not exist")
+                    return None
+
+        self.remember(user)
+        return user
+
+    async def resolve_all(self, user_ids: list[int]) -> dict[int, discord.User]:
+        """
+        Resolves the given user ids concurrently. Returns the users by id,
+        where the value is None for users that do not exist, and the
+        exception for users that could not be resolved.
+        """
+        results = await asyncio.gather(
+            *(self.resolve(user_id) for user_id in user_ids), return_exceptions=True
+        )
+        return dict(zip(user_ids, results))
+
+    def stats(self) -> dict:
+        return {"cached": len(self.cache), "hits": self.hits, "fetches": self.fetches}
@@ -0,0 +1,98 @@
+import heapq
+import logging
+import time
+from typing import Iterable
+
+from Event import Event
+
+# Statuses of events that are waiting for sign up to open
+WAITING_STATUSES = ("CLOSED", "TBA")
+
+
+class WakeupScheduler:
+    """
+    A timer heap of when events are due to open sign up. Each event waiting
+    for sign up is scheduled at its sign up start plus each of a few offsets,
+    so it can be refreshed right as sign up opens instead of at the next poll.
+    """
+
+    def __init__(self, offsets: Iterable[float]):
+        """
+        Initializes an empty scheduler. offsets are the seconds after a sign
+        up start to wake up at.
+        """
+        self.offsets = tuple(offsets)
+
+        # (wakeup time, event id, sign up start) ordered by wakeup time
+        self.heap: list[tuple[float, int, float]] = list()
+
+        # The sign up start each event is scheduled for. Heap entries with
+        # another sign up start are stale, and are skipped when popped.
+        self.scheduled: dict[int, float] = dict()
+
+    def __len__(self):
+        """Returns the number of scheduled events"""
+        return len(self.scheduled)
+
+    def update(self, events: Iterable[Event]) -> None:
+        """
+        Schedules the events that wait for sign up to open in the future,
+        and unschedules the rest.
+        """
+        now = time.time()
+        for event in events:
+            signup_start = None
+            if event.status in WAITING_STATUSES and event.signup_start is not None:
+                signup_start = event.signup_start.timestamp()
+                if signup_start + max(self.offsets, default=0) <= now:
+                    signup_start = None
+
+            if signup_start is None:
+                self.scheduled.pop(event.id, None)
+                continue
+            if self.scheduled.get(event.id) == signup_start:
+                continue
+
+            self.scheduled[event.id] = signup_start
+            for offset in self.offsets:
+                if signup_start + offset > now:
+                    heapq.heappush(
+                        self.heap, (signup_start + offset, event.id, signup_start)
+                    )
+
+    def _discard_stale(self) -> None:
+        while self.heap:
+            _, id, signup_start = self.heap[0]
+            if self.scheduled.get(id) == signup_start:
+                return
+            heapq.heappop(self.heap)
+
+    def next_wakeup(self) -> float:
+        """Returns the time of the next wakeup, None if nothing is scheduled"""
+        self._discard_stale()
+        return self.heap[0][0] if self.heap else None
+
+    def upcoming(self, now: float, within: float) -> int:
+        """Returns the number of scheduled sign ups starting in the next within seconds"""
+        return sum(
+            1
+            for signup_start in self.scheduled.values()
+            if now <= signup_start < now + within
+        )
+
+    def pop_due(self, now: float) -> set[int]:
+        """Returns the ids of the events with wakeups due at now, and removes the wakeups"""
+        result = set()
+        self._discard_stale()
+        while self.heap and self.heap[0][0] <= now:
+            _, id, signup_start = heapq.heappop(self.heap)
+            if self.scheduled.get(id) == signup_start:
+                result.add(id)
+
+        # Events past their last wakeup are done
+        for id in result:
+            if self.scheduled[id] + max(self.offsets, default=0) <= now:
+                del self.scheduled[id]
+
+        logging.debug(f"Woke up for events {result}")
+        return result
@@ -0,0 +1,105 @@
+import asyncio
+import logging
+from typing import Awaitable, Callable
+
+from Tracing import span
+
+
+class WriteBehind:
+    """
+    Persists values in a background task, so the caller never waits for the disk.
+    Values scheduled before the previous one is written are coalesced,
+    so a burst of changes results in a single write.
+    """
+
+    def __init__(
+        self,
+        write: Callable[[any], Awaitable[None]],
+        delay: float = 0,
+        merge: Callable[[any, any], any] = None,
+    ):
+        """
+        Initializes a new WriteBehind that writes values with write.
+        Writes wait delay seconds after a value is first scheduled, to let
+        more values coalesce. By default the latest value replaces a pending
+        one, merge can be given to combine the pending and the new value instead.
+        """
+        self.write = write
+        self.delay = delay
+        self.merge = merge
+
+        self.pending: any = None
+        self.dirty = False
+        self.writes = 0
+        self.coalesced = 0
+
+        self.task: asyncio.Task = None
+        self.wakeup: asyncio.Event = None
+        self.lock: asyncio.Lock = None
+
+    def start(self) -> None:
+        """Starts the background task. Has to be called from a running loop"""
+        if self.task is None:
+            self.wakeup = asyncio.Event()
+            self.lock = asyncio.Lock()
+            self.task = asyncio.create_task(self.run())
+
+    def schedule(self, value: any) -> None:
+        """Schedules value to be written"""
+        if self.dirty:
+            self.coalesced += 1
+            if self.merge is not None:
+                value = self.merge(self.pending, value)
+
+        self.pending = value
+        self.dirty = True
+        if self.wakeup is not None:
+            self.wakeup.set()
+
+    async def run(self) -> None:
+        """Writes pending values until cancelled"""
+        while True:
+            await self.wakeup.wait()
+            self.wakeup.clear()
+            if self.delay:
+                await asyncio.sleep(self.delay)
+
+            try:
+                await self.flush()
+            except Exception as e:
+                logging.error(f"Write behind failed, retrying later: '{e!r}'")
+                await asyncio.sleep(max(self.delay, 1))
+                self.wakeup.set()
+
+    async def flush(self) -> None:
+        """Writes the pending value, if any, right away"""
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+
+        async with self.lock:
+            if not self.dirty:
+                return
+            value = self.pending
+            self.pending = None
+            self.dirty = False
+
+            try:
+                with span("write_behind", write=self.write.__qualname__):
+                    await self.write(value)
+            except BaseException:
+                # Puts the value back unless a newer one replaced it
+                if not self.dirty:
+                    self.pending = value
+                    self.dirty = True
+                elif self.merge is not None:
+                    self.pending = self.merge(value, self.pending)
+                raise
+
+            self.writes += 1
+
+    async def close(self) -> None:
+        """Stops the background task and writes the pending value"""
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+        await self.flush()
@@ -0,0 +1,104 @@
+import asyncio
+import random
+
+from aiohttp import web
+
+
+class MockApi:
+    """
+    A local stand-in for the TIHLDE events api, serving a catalogue of events
+    as a paginated list and as single events. Responses can be delayed, and a
+    share of them can fail with "503 Service Unavailable".
+    """
+
+    def __init__(
+        self,
+        catalogue: dict[int, dict],
+        latency: float = 0,
+        error_rate: float = 0,
+        page_size: int = 25,
+        seed: int = 0,
+    ):
+        """
+        Initializes a server for catalogue, the json of each event by id.
+        Every response waits latency seconds, and fails with probability
+        error_rate.
+        """
+        self.catalogue = catalogue
+        self.latency = latency
+        self.error_rate = error_rate
+        self.page_size = page_size
+        self.random = random.Random(seed)
+
+        self.runner: web.AppRunner = None
+        self.url: str = None
+
+        # Metrics
+        self.requests = 0
+        self.errors = 0
+
+    @staticmethod
+    def list_entry(event: dict) -> dict:
+        """
+        Returns the entry of an event in the list of events. Like in the api,
+        it carries the status and sign up fields of the event, so changes to
+        them show in the list.
+        """
+        return dict(event)
+
+    async def _respond(self) -> web.Response:
+        """Returns an error response, or None if the request should succeed"""
+        self.requests += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if self.random.random() < self.error_rate:
+            self.errors += 1
+            return web.Response(status=503)
+        return None
+
+    async def list_events(self, request: web.Request) -> web.Response:
+        error = await self._respond()
+        if error is not None:
+            return error
+
+        page = int(request.query.get("page", 1))
+        ids = sorted(self.catalogue)
+        start = (page - 1) * self.page_size
+        results = [
+            self.list_entry(self.catalogue[id])
+            for id in ids[start : start + self.page_size]
+        ]
+        next = (
+            f"{self.url}?page={page + 1}" if start + self.page_size < len(ids) else None
+        )
+        return web.json_response({"results": results, "next": next})
+
+    async def get_event(self, request: web.Request) -> web.Response:
+        error = await self._respond()
+        if error is not None:
+            return error
+
+        event = self.catalogue.get(int(request.match_info["id"]))
+        if event is None:
+            return web.json_response({"detail": "Not found."}, status=404)
+        return web.json_response(event)
+
+    async def start(self) -> str:
+        """Starts the server on a free local port, and returns the endpoint url"""
+        app = web.Application()
+        app.router.add_get("/events/", self.list_events)
+        app.router.add_get("/events/{id}", self.get_event)
+
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", 0)
+        await site.start()
+
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f"http://127.0.0.1:{port}/events/"
+        return self.url
+
+    async def stop(self) -> None:
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
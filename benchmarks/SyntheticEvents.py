@@ -0,0 +1,126 @@
+import datetime
+import random
+
+from Event import Event
+from EventRecord import EventRecord
+
+STATUSES = ("EXPIRED", "CLOSED", "ACTIVE", "TBA", "NO_SIGNUP")
+WORDS = ("Bedpres", "Kurs", "Fest", "Workshop", "Foredrag", "Quiz", "Tur", "Lan")
+PLACES = ("Kjelhuset", "R5", "Realfagbygget", "Hangaren", "Digitalt", None)
+
+
+def make_event_json(id: int, rng: random.Random, now: datetime.datetime) -> dict:
+    """Returns the api json of a random event"""
+    start = now + datetime.timedelta(hours=rng.randint(-24 * 60, 24 * 60))
+    signup_start = start - datetime.timedelta(hours=rng.randint(24, 24 * 14))
+    status = rng.choice(STATUSES)
+    return {
+        "id": id,
+        "title": f"{rng.choice(WORDS)} {rng.choice(WORDS)} {id}",
+        "start_date": start.isoformat(),
+        "end_date": (start + datetime.timedelta(hours=3)).isoformat(),
+        "end_registration_at": (start - datetime.timedelta(hours=12)).isoformat(),
+        "start_registration_at": signup_start.isoformat(),
+        "location": rng.choice(PLACES),
+        "expired": status == "EXPIRED",
+        "closed": status == "CLOSED",
+        "sign_up": status == "ACTIVE",
+        "description": "TBA" if status == "TBA" else "Beskrivelse",
+    }
+
+
+def make_catalogue(size: int, seed: int = 0) -> dict[int, dict]:
+    """Returns the api json of size random events, by id"""
+    rng = random.Random(seed)
+    now = datetime.datetime.now(datetime.timezone.utc).replace(microsecond=0)
+    return {id: make_event_json(id, rng, now) for id in range(1, size + 1)}
+
+
+def to_event(data: dict) -> Event:
+    """Returns the event for the api json of an event, as `Event.get_event` would"""
+    if data["expired"]:
+        status = "EXPIRED"
+    elif data["closed"]:
+        status = "CLOSED"
+    elif data["sign_up"]:
+        status = "ACTIVE"
+    elif data["description"] == "TBA":
+        status = "TBA"
+    else:
+        status = "NO_SIGNUP"
+
+    return Event(
+        id=data["id"],
+        title=data["title"],
+        start=data["start_date"],
+        end=data["end_date"],
+        deadline=data["end_registration_at"],
+        signup_start=data["start_registration_at"],
+        place=data["location"],
+        status=status,
+    )
+
+
+def make_record(size: int, seed: int = 0) -> EventRecord:
+    """Returns an EventRecord of size random events"""
+    record = EventRecord()
+    for data in make_catalogue(size, seed).values():
+        record.add_event(to_event(data))
+    return record
+
+
+def _mutation(rng: random.Random, now: datetime.datetime):
+    """
+    Returns "open" to open sign up of an event, or else the new sign up
+    start to move it to, half of the time each.
+    """
+    if rng.random() < 0.5:
+        return "open"
+    return now + datetime.timedelta(hours=rng.randint(1, 24 * 7))
+
+
+def mutate(catalogue: dict[int, dict], fraction: float, seed: int = 0) -> dict:
+    """
+    Returns a copy of catalogue where a fraction of the events open sign up
+    or move their sign up start, and as many new events are added.
+    """
+    rng = random.Random(seed)
+    now = datetime.datetime.now(datetime.timezone.utc).replace(microsecond=0)
+    result = dict(catalogue)
+    count = max(1, int(len(catalogue) * fraction))
+
+    for id in rng.sample(sorted(catalogue), min(count, len(catalogue))):
+        data = dict(catalogue[id])
+        change = _mutation(rng, now)
+        if change == "open":
+            data.update(expired=False, closed=False, sign_up=True)
+        else:
+            data["start_registration_at"] = change.isoformat()
+        result[id] = data
+
+    first = max(catalogue, default=0) + 1
+    for id in range(first, first + count):
+        result[id] = make_event_json(id, rng, now)
+    return result
+
+
+def mutate_record(record: EventRecord, fraction: float, seed: int = 0) -> EventRecord:
+    """Returns a copy of record changed like `mutate` changes a catalogue"""
+    rng = random.Random(seed)
+    now = datetime.datetime.now(datetime.timezone.utc).replace(microsecond=0)
+    result = EventRecord()
+    result.eventrecord = dict(record.eventrecord)
+    count = max(1, int(len(record) * fraction))
+
+    for id in rng.sample(sorted(record.eventrecord), min(count, len(record))):
+        event = record.get_event(id)
+        change = _mutation(rng, now)
+        if change == "open":
+            result.add_event(event.replace(status="ACTIVE"))
+        else:
+            result.add_event(event.replace(signup_start=change))
+
+    first = max(record.eventrecord, default=0) + 1
+    for id in range(first, first + count):
+        result.add_event(to_event(make_event_json(id, rng, now)))
+    return result
@@ -0,0 +1,276 @@
+"""
+Times the main paths of a polling cycle against a local mock api and
+synthetic records, and prints the results as JSON.
+
+Run from the root of the repository:
+    python benchmarks/benchmark.py --output results.json
+"""
+
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+# The modules of the bot are in the parent directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import aiohttp
+
+import Codec
+import Digest
+from Dispatcher import Dispatcher
+from EventRecord import EventRecord
+from MockApi import MockApi
+from SyntheticEvents import make_catalogue, make_record, mutate, mutate_record
+from config import DISCORD_MESSAGE_LIMIT
+
+
+def use_endpoint(url: str) -> None:
+    """Points the modules that query the api to url"""
+    for name in ("Event", "EventRecord"):
+        setattr(sys.modules[name], "API_ENDPOINT", url)
+
+
+async def measure(run, repeats: int, **info) -> dict:
+    """
+    Calls run repeats times and returns the timings, along with the peak
+    memory allocated during an extra traced call. run is an async function
+    returning a dict of extra results.
+    """
+    timings = []
+    extra = {}
+    for _ in range(repeats):
+        t0 = time.perf_counter()
+        extra = await run()
+        timings.append(time.perf_counter() - t0)
+
+    tracemalloc.start()
+    await run()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    result = {
+        **info,
+        "repeats": repeats,
+        "seconds_min": min(timings),
+        "seconds_median": statistics.median(timings),
+        "peak_memory_bytes": peak,
+        **(extra or {}),
+    }
+    print(f"{result}", file=sys.stderr)
+    return result
+
+
+async def bench_fetch(args: argparse.Namespace, size: int) -> list[dict]:
+    """Times full and incremental refreshes from the mock api"""
+    catalogue = make_catalogue(size)
+    api = MockApi(catalogue, args.latency, args.error_rate, args.page_size)
+    use_endpoint(await api.start())
+    results = []
+
+    try:
+        async with aiohttp.ClientSession() as session:
+
+            async def full():
+                api.requests = 0
+                record = await EventRecord.get_updated(session)
+                return {"events": len(record), "requests": api.requests}
+
+            results.append(
+                await measure(full, args.repeats, scenario="get_updated", size=size)
+            )
+
+            previous = await EventRecord.get_updated(session)
+            api.catalogue = mutate(catalogue, args.change_rate)
+
+            async def incremental():
+                api.requests = 0
+                record = await EventRecord.get_updated(session, None, previous)
+                return {"events": len(record), "requests": api.requests}
+
+            results.append(
+                await measure(
+                    incremental,
+                    args.repeats,
+                    scenario="get_updated_incremental",
+                    size=size,
+                )
+            )
+
+            # A fast incremental refresh is no use if it misses changes
+            record = await EventRecord.get_updated(session, None, previous)
+            full_record = await EventRecord.get_updated(session)
+            if record.eventrecord != full_record.eventrecord:
+                raise RuntimeError(
+                    f"Incremental refresh of {size} events differs from a full refresh"
+                )
+    finally:
+        await api.stop()
+    return results
+
+
+async def bench_record(args: argparse.Namespace, size: int) -> list[dict]:
+    """Times diffing, combining and saving and loading a record"""
+    old = make_record(size)
+    new = mutate_record(old, args.change_rate)
+    results = []
+
+    async def diff():
+        changes = EventRecord.diff(old, new)
+        return {"changed": len(changes.changed), "added": len(changes.added)}
+
+    async def combine():
+        return {"events": len(EventRecord.diff(old, new).combine())}
+
+    results.append(await measure(diff, args.repeats, scenario="diff", size=size))
+    results.append(await measure(combine, args.repeats, scenario="combine", size=size))
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "events.json")
+
+        async def save():
+            await new.save_to_json(path)
+            return {"bytes": os.path.getsize(path)}
+
+        async def load():
+            return {"events": len(await EventRecord.from_json(path))}
+
+        results.append(
+            await measure(save, args.repeats, scenario="save_to_json", size=size)
+        )
+        results.append(
+            await measure(load, args.repeats, scenario="from_json", size=size)
+        )
+
+        for name, codec in Codec.CODECS.items():
+            snapshot_path = os.path.join(directory, f"events.{name}")
+
+            async def save_snapshot():
+                await Codec.save(new, snapshot_path, codec)
+                return {"bytes": os.path.getsize(snapshot_path)}
+
+            async def load_snapshot():
+                return {"events": len(await Codec.load(snapshot_path))}
+
+            results.append(
+                await measure(
+                    save_snapshot, args.repeats, scenario=f"save_{name}", size=size
+                )
+            )
+            results.append(
+                await measure(
+                    load_snapshot, args.repeats, scenario=f"load_{name}", size=size
+                )
+            )
+    return results
+
+
+class FakeUser:
+    """Stands in for a discord.User, where sending takes latency seconds"""
+
+    def __init__(self, id: int, latency: float):
+        self.id = id
+        self.latency = latency
+        self.received = 0
+
+    async def send(self, message: str) -> None:
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        self.received += 1
+
+    def __str__(self):
+        return f"FakeUser({self.id})"
+
+
+async def bench_fanout(args: argparse.Namespace, users: int) -> list[dict]:
+    """
+    Times rendering, packing and sending one cycle of notifications to
+    every user, with Discord's rate limits lifted to measure the overhead.
+    """
+    old = make_record(args.fanout_events)
+    changes = EventRecord.diff(old, mutate_record(old, args.change_rate))
+    fake_users = [FakeUser(id, args.latency) for id in range(users)]
+
+    async def fanout():
+        dispatcher = Dispatcher(1e9, 1e9, 1e9, args.concurrency, 0)
+        messages = Digest.pack(Digest.render(changes), DISCORD_MESSAGE_LIMIT)
+        jobs = [(user, message) for user in fake_users for _, message in messages]
+        await dispatcher.send_all(jobs)
+        return {"messages": len(jobs), **dispatcher.stats()}
+
+    return [await measure(fanout, args.repeats, scenario="fanout", size=users)]
+
+
+async def main(args: argparse.Namespace) -> dict:
+    results = []
+    for size in args.fetch_sizes:
+        results += await bench_fetch(args, size)
+    for size in args.record_sizes:
+        results += await bench_record(args, size)
+    for users in args.fanout_users:
+        results += await bench_fanout(args, users)
+
+    return {
+        "meta": {
+            "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "arguments": vars(args),
+        },
+        "results": results,
+    }
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+
+    def sizes(value: str) -> list[int]:
+        return [int(size) for size in value.split(",") if size]
+
+    parser.add_argument("--fetch-sizes", type=sizes, default=[100, 1000])
+    parser.add_argument(
+        "--record-sizes", type=sizes, default=[100, 1000, 10000, 100000]
+    )
+    parser.add_argument("--fanout-users", type=sizes, default=[100, 1000, 10000])
+    parser.add_argument("--fanout-events", type=int, default=100)
+    parser.add_argument("--change-rate", type=float, default=0.01)
+    parser.add_argument("--latency", type=float, default=0, help="seconds")
+    parser.add_argument("--error-rate", type=float, default=0)
+    parser.add_argument("--page-size", type=int, default=25)
+    parser.add_argument("--concurrency", type=int, default=25)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--quick", action="store_true", help="only small sizes")
+    parser.add_argument("--output", help="file to write the results to")
+
+    args = parser.parse_args()
+    if args.quick:
+        args.fetch_sizes = [size for size in args.fetch_sizes if size <= 100]
+        args.record_sizes = [size for size in args.record_sizes if size <= 1000]
+        args.fanout_users = [users for users in args.fanout_users if users <= 100]
+    return args
+
+
+if __name__ == "__main__":
+    # To remove RuntimeError on exit on windows as documented in this issue:
+    # https://github.com/encode/httpx/issues/914
+    if (
+        sys.version_info[0] == 3
+        and sys.version_info[1] >= 8
+        and sys.platform.startswith("win")
+    ):
+        asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
+
+    args = parse_args()
+    output = json.dumps(asyncio.run(main(args)), indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf8") as f:
+            f.write(output)
+    else:
+        print(output)
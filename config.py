@@ -1,7 +1,56 @@
 TEST_DATA_PATH = "test_data.json"
 DATA_PATH = "events.json"
 END_USER_PATH = "end_users.json"
-QUERY_INTERVAL = 5 * 60  # 5 minutes
+QUERY_INTERVAL = 5 * 60  # 5 minutes, the initial poll interval
+POLL_INTERVAL_MIN = 60  # seconds
+POLL_INTERVAL_MAX = 15 * 60  # seconds
+POLL_BACKOFF = 2  # interval multiplier per poll without changes
+SIGNUP_NEAR_WINDOW = 30 * 60  # seconds, sign ups this close keep polling frequent
 SITE_PATH = "https://tihlde.org/arrangementer/"
 API_ENDPOINT = "https://api.tihlde.org/events/"
 LOG_FILE_PATH = "arrangementer.log"
+MAX_CONCURRENT_REQUESTS = 8
+REQUEST_TIMEOUT = 10  # seconds
+MAX_RETRIES = 5
+BACKOFF_BASE = 0.5  # seconds
+BACKOFF_MAX = 30  # seconds
+RETRY_AFTER_MAX = 2 * 60  # seconds, requests give up on longer Retry-After
+CONNECTION_LIMIT_PER_HOST = 8
+KEEPALIVE_TIMEOUT = 16 * 60  # seconds, outlives POLL_INTERVAL_MAX
+DNS_CACHE_TTL = 10 * 60  # seconds
+CACHE_DIR = "cache"
+CACHE_MAX_BYTES = 16 * 1024 * 1024  # 16 MiB
+INCREMENTAL_REFRESH = True
+FULL_REFRESH_INTERVAL = 60 * 60  # 1 hour
+SAVE_DELAY = 1  # seconds, lets writes coalesce
+JOURNAL_PATH = "events.journal"
+JOURNAL_COMPACT_EVERY = 500  # events appended to the journal
+SNAPSHOT_FORMAT = "json"  # "json" or "binary"
+EXPIRED_RETENTION = 180 * 24 * 60 * 60  # 180 days
+STORAGE_BACKEND = "json"  # "json" or "sqlite"
+SQLITE_PATH = "arrangementer.sqlite3"
+DISCORD_GLOBAL_RATE = 45  # requests per second, Discord allows 50
+DISCORD_ROUTE_RATE = 1  # messages per second to a single user (5 per 5 seconds)
+DISCORD_ROUTE_BURST = 5
+NOTIFY_CONCURRENCY = 25
+NOTIFY_MAX_RETRIES = 3
+LEDGER_PATH = "deliveries.sqlite3"
+DISCORD_MESSAGE_LIMIT = 2000  # characters
+DIGEST_WINDOW = 0  # seconds notifications wait in the outbox to be sent together
+OUTBOX_BATCH_SIZE = 5000  # notifications sent per drain
+OUTBOX_RETRY_BASE = 5  # seconds
+OUTBOX_RETRY_MAX = 10 * 60  # seconds
+OUTBOX_MAX_ATTEMPTS = 8
+SIGNUP_WAKEUP_OFFSETS = (0, 3, 15, 60)  # seconds after sign up start to refresh
+USER_FETCH_CONCURRENCY = 10  # users fetched from Discord at the same time
+USER_CACHE_SIZE = 10000  # resolved users kept in memory
+QUERY_LIMIT = 10  # events listed by the "neste" command
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = 9108  # None to not serve metrics
+TRACE_PATH = None  # ex. "spans.jsonl" to write tracing spans as JSON lines
+PROFILE_MODE = None  # "cprofile" or "tracemalloc" to profile the first full cycle
+PROFILE_PATH = "profile"  # stats are written to files starting with this
+DEPLOYMENT_MODE = "single"  # default of the DEPLOYMENT_MODE environment variable
+FEED_POLL_INTERVAL = 1  # seconds between checks of the feed, as "notifier"
+FEED_BATCH_SIZE = 100  # feed entries consumed at a time
+POLLER_METRICS_PORT = 9109  # None to not serve metrics, as "poller"
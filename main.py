@@ -1,256 +1,787 @@
 import asyncio
+import contextlib
+import datetime
 import logging
+import os
 import sys
-import aiofiles
+import aiohttp
 import discord
 import time
-import json
-
-from EventRecord import EventRecord
+from dotenv import load_dotenv
+
+from ChangeFeed import ChangeFeed
+import Codec
+from DeliveryLedger import DeliveryLedger, Notification
+from Dispatcher import FAILED, REFUSED, SENT, Dispatcher
+import Digest
+from Event import Event, to_datetime
+from EventIndex import EventIndex
+from EventJournal import EventJournal
+from EventRecord import Changeset, EventRecord
+from HelperFunctions import connector_stats
+from Metrics import (
+    CYCLE_DURATION,
+    EVENT_CHANGES,
+    OUTBOX_WAIT,
+    SIGNUP_TO_NOTIFY,
+    MetricsServer,
+)
+from Outbox import Outbox, OutboxEntry
+from PollInterval import PollInterval
+from ResponseCache import ResponseCache
+from SqliteStorage import SqliteDatabase, SqliteEventStore, SqliteUserStore
+from Storage import EventStore, JsonUserStore, UserStore
+from SubscriberRegistry import SubscriberRegistry
+from Subscriptions import Subscription, SubscriptionIndex
+from Tracing import export_spans, profile, span
+from UserResolver import UserResolver
+from WakeupScheduler import WakeupScheduler
+from WriteBehind import WriteBehind
 from config import (
+    CACHE_DIR,
+    CACHE_MAX_BYTES,
+    CONNECTION_LIMIT_PER_HOST,
     DATA_PATH,
+    DEPLOYMENT_MODE,
+    DIGEST_WINDOW,
+    DISCORD_GLOBAL_RATE,
+    DISCORD_MESSAGE_LIMIT,
+    DISCORD_ROUTE_BURST,
+    DISCORD_ROUTE_RATE,
+    DNS_CACHE_TTL,
+    EXPIRED_RETENTION,
+    FEED_BATCH_SIZE,
+    FEED_POLL_INTERVAL,
+    JOURNAL_COMPACT_EVERY,
+    JOURNAL_PATH,
+    KEEPALIVE_TIMEOUT,
+    LEDGER_PATH,
     LOG_FILE_PATH,
+    METRICS_HOST,
+    METRICS_PORT,
+    NOTIFY_CONCURRENCY,
+    NOTIFY_MAX_RETRIES,
+    OUTBOX_BATCH_SIZE,
+    OUTBOX_MAX_ATTEMPTS,
+    OUTBOX_RETRY_BASE,
+    OUTBOX_RETRY_MAX,
+    POLL_BACKOFF,
+    POLL_INTERVAL_MAX,
+    POLL_INTERVAL_MIN,
+    POLLER_METRICS_PORT,
+    PROFILE_MODE,
+    PROFILE_PATH,
     QUERY_INTERVAL,
+    QUERY_LIMIT,
+    SAVE_DELAY,
+    SIGNUP_NEAR_WINDOW,
     SITE_PATH,
+    SIGNUP_WAKEUP_OFFSETS,
+    SNAPSHOT_FORMAT,
+    SQLITE_PATH,
+    TRACE_PATH,
+    STORAGE_BACKEND,
+    USER_CACHE_SIZE,
+    USER_FETCH_CONCURRENCY,
     END_USER_PATH,
 )
 
+# How the client runs: everything in one process, or as a poller and a
+# notifier process that share the changes through a feed
+DEPLOYMENT_MODES = ("single", "poller", "notifier")
+
 
 class Client(discord.Client):
     """
     Inherrits discord.Client and adds special methods.
     """
 
-    async def main_loop(self):
+    def __init__(self, *args, mode: str = DEPLOYMENT_MODE, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        if mode not in DEPLOYMENT_MODES:
+            raise ValueError(f"Unknown deployment mode '{mode}'")
+        self.mode = mode
+
+        # Shared between polling cycles, created on first use
+        self.session: aiohttp.ClientSession = None
+        self.response_cache: ResponseCache = None
+
+        # The current state of all events. Loaded from disk at startup and
+        # kept in memory after that, disk is only written to.
+        self.record: EventRecord = None
+
+        # Indexes over the events in the record, for answering queries
+        self.event_index = EventIndex()
+        self.event_store, self.user_store = self.open_stores()
+
+        # The registered users by id, with cached metadata. Resolved to
+        # discord.User objects only when they are sent a message.
+        self.end_users = SubscriberRegistry(self.user_store, SAVE_DELAY)
+        self.subscriptions = SubscriptionIndex()
+        self.user_resolver = UserResolver(self, USER_FETCH_CONCURRENCY, USER_CACHE_SIZE)
+
+        # "cprofile" or "tracemalloc" to profile the next full cycle
+        self.profile_next_cycle: str = PROFILE_MODE
+
+        # Serves the metrics, if METRICS_PORT is set
+        self.metrics_server: MetricsServer = None
+
+        # How long to wait between polls
+        self.poll_interval = PollInterval(
+            QUERY_INTERVAL, POLL_INTERVAL_MIN, POLL_INTERVAL_MAX, POLL_BACKOFF
+        )
+
+        # When to refresh events as their sign up opens
+        self.wakeups = WakeupScheduler(SIGNUP_WAKEUP_OFFSETS)
+
+        # Changed events are saved in the background
+        self.record_writer = WriteBehind(
+            self.event_store.append,
+            delay=SAVE_DELAY,
+            merge=lambda pending, events: {**pending, **events},
+        )
+
+        # Sends notifications concurrently within Discord's rate limits
+        self.dispatcher = Dispatcher(
+            DISCORD_GLOBAL_RATE,
+            DISCORD_ROUTE_RATE,
+            DISCORD_ROUTE_BURST,
+            NOTIFY_CONCURRENCY,
+            NOTIFY_MAX_RETRIES,
+        )
+
+        # Which notifications each user has received, and the notifications
+        # waiting to be sent
+        deliveries = SqliteDatabase(
+            LEDGER_PATH, DeliveryLedger.SCHEMA + Outbox.SCHEMA + ChangeFeed.SCHEMA
+        )
+        self.ledger = DeliveryLedger(deliveries)
+        self.outbox = Outbox(
+            deliveries, OUTBOX_RETRY_BASE, OUTBOX_RETRY_MAX, OUTBOX_MAX_ATTEMPTS
+        )
+
+        # Carries the changes from the poller to the notifier, when they run
+        # as separate processes
+        self.feed: ChangeFeed = None
+        if self.mode != "single":
+            self.feed = ChangeFeed(deliveries)
+
+    @staticmethod
+    def open_stores() -> tuple[EventStore, UserStore]:
+        """
+        Returns the stores for events and users given by STORAGE_BACKEND
+        """
+        if STORAGE_BACKEND == "sqlite":
+            database = SqliteDatabase(
+                SQLITE_PATH, SqliteEventStore.SCHEMA + SqliteUserStore.SCHEMA
+            )
+            return (
+                SqliteEventStore(database, JOURNAL_COMPACT_EVERY, EXPIRED_RETENTION),
+                SqliteUserStore(database),
+            )
+
+        return (
+            EventJournal(
+                DATA_PATH,
+                JOURNAL_PATH,
+                JOURNAL_COMPACT_EVERY,
+                EXPIRED_RETENTION,
+                Codec.CODECS[SNAPSHOT_FORMAT],
+            ),
+            JsonUserStore(END_USER_PATH),
+        )
+
+    def get_session(self) -> aiohttp.ClientSession:
         """
-        The main loop of the program. Checks for updates in events in the interval specified by QUERY_INTERVAL
+        Returns the session used to query the api. The session and its
+        connection pool is kept alive between polling cycles.
         """
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(
+                limit_per_host=CONNECTION_LIMIT_PER_HOST,
+                keepalive_timeout=KEEPALIVE_TIMEOUT,
+                ttl_dns_cache=DNS_CACHE_TTL,
+            )
+            self.session = aiohttp.ClientSession(connector=connector)
+        return self.session
+
+    async def get_response_cache(self) -> ResponseCache:
+        """
+        Returns the cache of api responses, loading it from disk on first use.
+        """
+        if self.response_cache is None:
+            self.response_cache = await ResponseCache.load(CACHE_DIR, CACHE_MAX_BYTES)
+        return self.response_cache
 
-        self.everyone_notified: bool = True
+    def session_stats(self) -> dict:
+        """Returns stats about the connection pool of the shared session"""
+        if self.session is None or self.session.closed:
+            return {}
+        return connector_stats(self.session.connector)
 
-        while True:
-            # Updates the records if everyone is up to speed with the current updates
-            if self.everyone_notified:
-                t0 = time.time()
-                try:
-                    # Fetch the saved verion from file and an updated version from the api
-                    new, old = await self.get_new_and_old()
-                except Exception as e:
-                    logging.warning(
-                        f"Exception '{e}' caught when retriving new EventRecord"
-                    )
-                    continue
+    async def load_record(self) -> None:
+        """
+        Loads the EventRecord from disk and starts persisting it in the background.
+        """
+        self.record = await self.event_store.load()
+        self.event_index = EventIndex.from_record(self.record)
+        self.record_writer.start()
+        self.wakeups.update(self.record.eventrecord.values())
 
-                newly_opened = EventRecord.get_newly_opened_events(old, new)
-                new_events = EventRecord.get_new_events(old, new)
-                new_sign_up_start = EventRecord.get_new_signup_start(old, new)
+    def apply_changes(self, changes: Changeset) -> None:
+        """
+        Replaces the current EventRecord with the combined record of changes,
+        and schedules the changed events to be saved.
+        """
+        self.record = changes.combine()
+        updated = changes.updated()
+        self.record_writer.schedule(updated)
+        self.event_index.update(updated.values())
+        self.wakeups.update(updated.values())
 
-            # Self.everyone_notified gets set to False if new events are discovered
-            if len(newly_opened) != 0:
-                self.everyone_notified = False
-                logging.info(
-                    f"Newly opened events: {list(newly_opened.eventrecord.keys())}"
-                )
+    async def compact_record(self) -> None:
+        """
+        Prunes old expired events and compacts the saved record,
+        if the store is due for compaction.
+        """
+        if not self.event_store.needs_compaction():
+            return
+
+        before = self.record.eventrecord.keys()
+        self.record = self.event_store.prune(self.record)
+        self.event_index.retain(self.record.eventrecord.keys())
+        await self.record_writer.flush()
+        await self.event_store.compact(self.record)
+
+        # The notifier process prunes its deliveries when it gets the removals
+        if self.feed is not None:
+            removed = before - self.record.eventrecord.keys()
+            if removed:
+                await self.feed.publish([], removed=removed)
+            return
+        await self.ledger.prune(self.record.eventrecord.keys())
+        await self.outbox.prune_messages()
+
+    async def close(self):
+        """
+        Saves pending changes and closes the shared session before closing the client
+        """
+        await self.record_writer.close()
+        await self.event_store.close()
+        await self.end_users.close()
+        await self.user_store.close()
+        await self.ledger.close()
+        await self.outbox.close()
+        if self.feed is not None:
+            await self.feed.close()
+        if self.metrics_server is not None:
+            await self.metrics_server.close()
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+        await super().close()
+
+    async def main_loop(self):
+        """
+        The main loop of the program. Checks for updates in events in an interval
+        that adapts to how often events change, and refreshes events right as
+        their sign up opens in between.
+        """
+        next_poll = time.time()
 
-            if len(new_events) != 0:
-                self.everyone_notified = False
-                logging.info(f"New events: {list(new_events.eventrecord.keys())}")
+        while True:
+            now = time.time()
+            wakeup = self.wakeups.next_wakeup()
 
-            if len(new_sign_up_start) != 0:
-                self.everyone_notified = False
-                logging.info(
-                    f"Newly changed sign-up start :{list(new_sign_up_start.eventrecord.keys())}"
-                )
+            # Refreshes only the events where sign up is opening
+            if wakeup is not None and wakeup < next_poll:
+                if wakeup > now:
+                    await asyncio.sleep(wakeup - now)
+                    continue
+                await self.update_record(self.wakeups.pop_due(now))
+                continue
 
-            # Notifies users if everyone is not up to speed
-            if not self.everyone_notified:
-                result_new = await client.notify_users_new(new_events)
-                result_newly_opened = await client.notify_users_newly_opened(
-                    newly_opened
-                )
-                result_new_signup_start = await client.notify_users_new_sign_up_start(
-                    new_sign_up_start
-                )
+            if next_poll > now:
+                await asyncio.sleep(next_poll - now)
+                continue
 
-                # Sets self.everyone_notified to True if all functions ran without issue
-                self.everyone_notified = all(
-                    (result_new, result_newly_opened, result_new_signup_start)
-                )
+            changes = await self.update_record()
+            changed = changes is not None and bool(
+                changes.added.eventrecord
+                or changes.opened.eventrecord
+                or changes.signup_changed.eventrecord
+            )
+            upcoming = self.wakeups.upcoming(time.time(), SIGNUP_NEAR_WINDOW)
+            next_poll = now + self.poll_interval.update(changed, upcoming)
 
-            if self.everyone_notified:
-                # Save the new EventRecord
-                await EventRecord.combine(old, new).save_to_json(DATA_PATH)
+    async def update_record(self, ids: set[int] = None) -> Changeset:
+        """
+        Gets an updated EventRecord from the api, or refreshes only the events
+        with the given ids, and enqueues notifications about the changes.
+        Returns the applied changes, None if the update failed.
+        The cycle is traced, and the next full cycle is profiled if
+        profile_next_cycle is set.
+        """
+        mode = "full" if ids is None else "targeted"
+        profiler = contextlib.nullcontext()
+        if ids is None and self.profile_next_cycle is not None:
+            profiler = profile(self.profile_next_cycle, PROFILE_PATH)
+            self.profile_next_cycle = None
+
+        t0 = time.monotonic()
+        with profiler, span("cycle", mode=mode) as cycle:
+            changes = await self.run_cycle(ids)
+            if cycle is not None and changes is not None:
+                cycle.set(changes=str(changes))
+        CYCLE_DURATION.observe(time.monotonic() - t0, mode=mode)
+        return changes
+
+    async def run_cycle(self, ids: set[int] = None) -> Changeset:
+        """The stages of `update_record`"""
+        try:
+            # Gets the current version and an updated version from the api
+            with span("fetch", events=len(ids) if ids else None):
+                new, old = await self.get_new_and_old(ids)
+        except Exception as e:
+            logging.warning(f"Exception '{e}' caught when retriving new EventRecord")
+            return None
+
+        with span("diff"):
+            changes = EventRecord.diff(old, new)
+        EVENT_CHANGES.inc(len(changes.added), kind="added")
+        EVENT_CHANGES.inc(len(changes.removed), kind="removed")
+        EVENT_CHANGES.inc(len(changes.changed), kind="changed")
+        for kind, record in changes.kinds.items():
+            EVENT_CHANGES.inc(len(record), kind=kind)
+
+        with span("render"):
+            rendered = Digest.render(changes)
+        if rendered:
+            logging.info(
+                f"New events: {list(changes.added.eventrecord.keys())}, "
+                f"newly opened events: {list(changes.opened.eventrecord.keys())}, "
+                f"newly changed sign-up start: {list(changes.signup_changed.eventrecord.keys())}"
+            )
+
+        # The record is only updated once the notifications are safely in the
+        # outbox (or the feed), otherwise the changes are found again next
+        # cycle. The notifier process keeps its own copy of the record, so
+        # every updated event is published.
+        try:
+            if self.feed is not None:
+                updated = changes.updated()
+                if updated:
+                    with span("publish", events=len(updated)):
+                        await self.feed.publish(updated.values(), rendered)
+            elif rendered:
+                with span("enqueue", notifications=len(rendered)):
+                    await self.enqueue_notifications(changes.new.eventrecord, rendered)
+        except Exception as e:
+            logging.error(f"Exception '{e}' caught when enqueuing notifications")
+            return None
+
+        # Save the new EventRecord
+        with span("apply"):
+            self.apply_changes(changes)
+        try:
+            with span("compact"):
+                await self.compact_record()
+        except Exception as e:
+            logging.error(f"Exception '{e}' caught when compacting the record")
 
-                await asyncio.sleep(QUERY_INTERVAL - (time.time() - t0))
-            else:
-                # Waits 500ms before retrying
-                await asyncio.time.sleep(0.5)
+        return changes
 
-    async def get_new_and_old(self) -> tuple[EventRecord, EventRecord]:
+    async def get_new_and_old(
+        self, ids: set[int] = None
+    ) -> tuple[EventRecord, EventRecord]:
         """
-        Gets an old EventRecord from disk, and a new EventRecord from the API
+        Gets the current EventRecord, and a new EventRecord from the API.
+        Only the events with the given ids are fetched, if ids are given.
         """
-        new = await EventRecord.get_updated()
-        old = await EventRecord.from_json(DATA_PATH)
-        logging.info("Fetched a new EventRecord")
+        cache = await self.get_response_cache()
+        old = self.record
+        if ids is None:
+            new = await EventRecord.get_updated(self.get_session(), cache, old)
+            logging.info("Fetched a new EventRecord")
+        else:
+            new = await EventRecord.get_refreshed(old, ids, self.get_session(), cache)
+            logging.info(f"Refreshed events {sorted(ids)}")
+        await cache.save_index()
+        logging.debug(f"Connection pool: {self.session_stats()}")
+        logging.debug(f"Response cache: {cache.stats()}")
 
         return new, old
 
-    async def load_end_users(self, path: str) -> set[int]:
+    async def load_end_users(self) -> None:
         """
-        Loads users from a JSON file specified with path.
-        The JSON file contains a list of user ids.
+        Loads the registered users and indexes their subscriptions.
         """
-        try:
-            with open(path, "r") as f:
-                user_ids: list[int] = json.load(f)
-            self.end_users: list[discord.User] = list()
-            for user_id in user_ids:
-                user = await client.fetch_user(user_id)
-                if user is not None:
-                    self.end_users.append(user)
-        except FileNotFoundError:
-            self.end_users: list[discord.User] = list()
-
-        logging.info(f"Loaded {len(self.end_users)} end users")
+        await self.end_users.load()
+        for user_id in self.end_users:
+            metadata = self.end_users.get(user_id)
+            subscription = Subscription.from_json(metadata.get("subscription"))
+            self.subscriptions.update(user_id, subscription)
 
-    async def append_end_user(self, path: str, user: discord.User):
+    async def append_end_user(self, user: discord.User):
         """
-        Adds a user to the user register and saves it to a given path.
+        Adds a user to the user register, which is saved in the background.
         """
-        if user not in self.end_users:
-            self.end_users.append(user)
+        # Signing up again lifts a quarantine
+        await self.ledger.release(user.id)
+        self.user_resolver.remember(user)
+
+        metadata = {**(self.end_users.get(user.id) or {}), "name": str(user)}
+        if self.end_users.add(user.id, metadata):
+            self.subscriptions.update(user.id, Subscription())
             logging.info(f"User '{user}' added.")
-            asyncio.create_task(self.save_end_users(path))
 
-    async def remove_end_user(self, path: str, user: discord.User) -> None:
+    async def remove_end_user(self, user: discord.User) -> None:
         """
-        Removes a user form the user register and saves it to a given path.
+        Removes a user form the user register, which is saved in the background.
         """
-        if user in self.end_users:
-            self.end_users.remove(user)
+        if self.end_users.remove(user.id):
+            self.subscriptions.remove(user.id)
+            self.user_resolver.forget(user.id)
             logging.info(f"User '{user}' removed.")
-            asyncio.create_task(self.save_end_users(path))
 
-    async def save_end_users(self, path: str) -> None:
+    async def update_subscription(self, user: discord.User, args: list[str]) -> str:
         """
-        Saves the user regisrer to a given path as a list of user ids.
+        Changes the subscription of a registered user by the arguments of a
+        filter command, and returns the reply. Shows the subscription if no
+        arguments are given.
         """
-        users = [user.id for user in self.end_users]
-        async with aiofiles.open(path, "w") as f:
-            f.write(json.dumps(users))
-
-    async def notify_users_new(self, new_events: EventRecord) -> bool:
+        if user.id not in self.end_users:
+            return "Du er ikke registrert. Skriv 'start' for å få varsler."
+
+        subscription = self.subscriptions.get(user.id)
+        if args:
+            try:
+                subscription = subscription.parse(args)
+            except ValueError as e:
+                return str(e)
+
+            metadata = {
+                **self.end_users.get(user.id),
+                "subscription": subscription.to_json(),
+            }
+            self.end_users.add(user.id, metadata)
+            self.subscriptions.update(user.id, subscription)
+            logging.info(f"User '{user}' changed subscription: {subscription}")
+
+        return subscription.describe()
+
+    def answer_query(self, command: str) -> str:
         """
-        Notifies users of new events. Returns True if successfull and False if not.
+        Answers a query command from the event index: "åpne" lists the events
+        open for sign up, "neste" the next events to open sign up and "uke"
+        the events that start this week.
         """
-        for event in new_events.eventrecord.values():
-
-            # Sets message according to event status
-            if event.status == "CLOSED":
-                message = (
-                    f"Nytt arrangement lagt ut ({event.title}): {SITE_PATH}{event.id}/\n"
-                    f"Påmeldingen starter {event.signup_start}."
-                )
-            elif event.status == "ACTIVE":
-                message = f"Nytt arrangement åpnet påmelding ({event.title}): {SITE_PATH}{event.id}/"
-            elif event.status == "TBA":
-                message = (
-                    f"Nytt arrangement lagt ut ({event.title}): {SITE_PATH}{event.id}/\n"
-                    f"Detaljene er ennå ikke annonsert. Påmelding starter angivelig {event.signup_start}"
-                )
-            elif event.status == "NO_SIGNUP":
-                message = (
-                    f"Nytt arrangement lagt ut ({event.title}): {SITE_PATH}{event.id}/\n"
-                    f"Arrangementet krever ikke påmelding."
-                )
-            # Continues loop if event status does not match anything to avoid endless
-            # loops due to errors because of messange not beeing defined.
+        now = datetime.datetime.now().astimezone()
+
+        if command == "åpne":
+            events = sorted(
+                self.event_index.with_status("ACTIVE"),
+                key=lambda event: (
+                    event.deadline.timestamp() if event.deadline else float("inf")
+                ),
+            )
+            title = "Åpne for påmelding"
+            lines = [
+                f"{event.title}: {SITE_PATH}{event.id}/ (frist {event.deadline})"
+                for event in events
+            ]
+        elif command == "neste":
+            events = self.event_index.between("signup_start", now, limit=QUERY_LIMIT)
+            title = "Neste påmeldinger"
+            lines = [
+                f"{event.title}: {SITE_PATH}{event.id}/ (åpner {event.signup_start})"
+                for event in events
+            ]
+        else:
+            monday = (now - datetime.timedelta(days=now.weekday())).replace(
+                hour=0, minute=0, second=0, microsecond=0
+            )
+            events = self.event_index.between(
+                "start", monday, monday + datetime.timedelta(days=7)
+            )
+            title = "Denne uken"
+            lines = [
+                f"{event.title}: {SITE_PATH}{event.id}/ (starter {event.start})"
+                for event in events
+            ]
+
+        if not lines:
+            return f"{title}: ingen arrangementer"
+
+        # Keeps as many lines as fit in one message
+        reply = f"{title}:"
+        for line in lines:
+            if len(reply) + 1 + len(line) > DISCORD_MESSAGE_LIMIT:
+                break
+            reply += f"\n{line}"
+        return reply
+
+    async def enqueue_notifications(
+        self, events: dict[int, Event], rendered: list[tuple[Notification, str]]
+    ) -> None:
+        """
+        Enqueues the rendered notifications in the outbox for every registered
+        user that is subscribed to them, has not received them and is not
+        quarantined. events has the events the notifications are about, by id.
+        """
+        entries = [
+            (user_id, notification)
+            for notification, _ in rendered
+            for user_id in self.subscriptions.match(
+                events[notification.event_id], notification.kind
+            )
+            if not self.ledger.is_quarantined(user_id)
+            and not self.ledger.is_delivered(user_id, notification)
+        ]
+        await self.outbox.enqueue(rendered, entries)
+
+    async def feed_loop(self):
+        """
+        Consumes the changes published by the poller process, for as long as
+        the client runs. Used instead of `main_loop` when the mode is
+        "notifier".
+        """
+        while True:
+            try:
+                consumed = await self.consume_feed()
+            except Exception as e:
+                logging.error(f"Exception '{e}' caught when consuming the feed")
+                consumed = 0
+            if not consumed:
+                await asyncio.sleep(FEED_POLL_INTERVAL)
+
+    async def consume_feed(self) -> int:
+        """
+        Applies the changes published by the poller to the record and its
+        index, and enqueues the notifications about them in the outbox.
+        Returns the number of consumed entries.
+        """
+        entries = await self.feed.read(FEED_BATCH_SIZE)
+        if not entries:
+            return 0
+
+        with span("consume", entries=len(entries)):
+            removed = False
+            for entry in entries:
+                events = {event.id: event for event in entry.events}
+                for event in entry.events:
+                    self.record.add_event(event)
+                self.event_index.update(entry.events)
+                for id in entry.removed:
+                    self.record.eventrecord.pop(id, None)
+                    self.event_index.remove(id)
+                    removed = True
+                if entry.rendered:
+                    await self.enqueue_notifications(events, entry.rendered)
+
+            if removed:
+                await self.ledger.prune(self.record.eventrecord.keys())
+                await self.outbox.prune_messages()
+            await self.feed.acknowledge(entries[-1].seq)
+
+        logging.debug(f"Consumed {len(entries)} entries from the feed")
+        return len(entries)
+
+    async def notifier_loop(self):
+        """
+        Drains the outbox for as long as the client runs, independently of polling.
+        """
+        while True:
+            try:
+                delay = await self.drain_outbox()
+            except Exception as e:
+                logging.error(f"Exception '{e}' caught when draining the outbox")
+                delay = 1
+            await self.outbox.wait(delay)
+
+    async def drain_outbox(self) -> float:
+        """
+        Sends the notifications in the outbox that are due, merging the
+        notifications for each user into as few messages as possible.
+        Sent notifications are marked as delivered, users that refuse the
+        messages or no longer exist are quarantined, and other failures are
+        retried later, until they have failed OUTBOX_MAX_ATTEMPTS times.
+        Returns the seconds until the next notification is due, or None if
+        the outbox is empty.
+        """
+        with span("drain") as drain:
+            delay = await self.drain_outbox_batch()
+            if drain is not None:
+                drain.set(delay=delay)
+        return delay
+
+    async def drain_outbox_batch(self) -> float:
+        """The stages of `drain_outbox`"""
+        now = time.time()
+        entries = await self.outbox.ready(now - DIGEST_WINDOW, OUTBOX_BATCH_SIZE)
+
+        # Entries for users that left, are quarantined or already have the notification
+        dropped = []
+        by_user: dict[int, list[OutboxEntry]] = dict()
+        for entry in entries:
+            if (
+                entry.user_id not in self.end_users
+                or self.ledger.is_quarantined(entry.user_id)
+                or self.ledger.is_delivered(entry.user_id, entry.notification)
+            ):
+                dropped.append((entry.user_id, entry.notification))
             else:
-                logging.warning(
-                    f"Event with id {event.id} does not have a valid status [status: '{event.status}']"
-                )
+                by_user.setdefault(entry.user_id, []).append(entry)
+
+        # Users that no longer exist are quarantined, and users that could not
+        # be fetched are retried like failed messages
+        with span("resolve_users", users=len(by_user)):
+            users = await self.user_resolver.resolve_all(list(by_user))
+        missing = {user_id for user_id, user in users.items() if user is None}
+        unresolved = {
+            user_id for user_id, user in users.items() if isinstance(user, Exception)
+        }
+        for user_id in unresolved:
+            logging.warning(f"Could not fetch user {user_id}: '{users[user_id]}'")
+
+        # Users with the same notifications get the same messages,
+        # so each distinct set is only packed once.
+        packed: dict[tuple[Notification, ...], list] = dict()
+        jobs = []
+        for user_id, user_entries in by_user.items():
+            if user_id in missing or user_id in unresolved:
                 continue
-
-            # Sends the message to each registered user
-            for user in self.end_users:
-                try:
-                    await user.send(message)
-
-                # Something went wrong
-                except Exception as e:
-                    logging.warning(
-                        f"Somethng unexpected happened while notifying users of newly opened events: '{e}'"
-                    )
-                    return False
-
-                logging.debug(
-                    f"Messaged user {user} about newly added {event.status} event"
+            key = tuple(entry.notification for entry in user_entries)
+            if key not in packed:
+                packed[key] = Digest.pack(
+                    [(entry.notification, entry.message) for entry in user_entries],
+                    DISCORD_MESSAGE_LIMIT,
                 )
-
-        return True
-
-    async def notify_users_newly_opened(self, new_events: EventRecord) -> bool:
+            jobs.extend(
+                (user_id, notifications, message)
+                for notifications, message in packed[key]
+            )
+
+        with span("send", messages=len(jobs)):
+            outcomes = await self.dispatcher.send_all(
+                [(users[user_id], message) for user_id, _, message in jobs]
+            )
+
+        sent = [
+            (user_id, notification)
+            for (user_id, notifications, _), outcome in zip(jobs, outcomes)
+            if outcome == SENT
+            for notification in notifications
+        ]
+        refused = {
+            user_id
+            for (user_id, _, _), outcome in zip(jobs, outcomes)
+            if outcome == REFUSED
+        }
+        failed = {
+            (user_id, notification)
+            for (user_id, notifications, _), outcome in zip(jobs, outcomes)
+            if outcome == FAILED
+            for notification in notifications
+        }
+        failed.update(
+            (user_id, entry.notification)
+            for user_id in unresolved
+            for entry in by_user[user_id]
+        )
+
+        await self.ledger.mark_delivered(sent)
+        self.observe_sent(by_user, sent)
+        await self.outbox.remove(sent + dropped)
+        exhausted = await self.outbox.postpone(
+            entry for entry in entries if (entry.user_id, entry.notification) in failed
+        )
+        await self.ledger.quarantine(refused, "Refused direct messages")
+        await self.ledger.quarantine(missing, "User not found")
+        await self.outbox.remove_users(refused | missing)
+
+        # Failures that outlast every retry are most likely on Discord's side
+        # (ex. an outage), so the notifications are dropped but the users
+        # keep getting new ones
+        if exhausted:
+            logging.warning(
+                f"Dropped {len(exhausted)} notifications that failed "
+                f"{self.outbox.max_attempts} times, for users "
+                f"{sorted({user_id for user_id, _ in exhausted})}"
+            )
+            await self.outbox.remove(exhausted)
+
+        if entries:
+            logging.info(f"Outbox: {await self.outbox.stats()}")
+            logging.debug(f"Users: {self.user_resolver.stats()}")
+
+        # More entries are ready
+        if len(entries) == OUTBOX_BATCH_SIZE:
+            return 0
+
+        due = await self.outbox.next_due(DIGEST_WINDOW)
+        return None if due is None else max(0, due - time.time())
+
+    @staticmethod
+    def observe_sent(
+        by_user: dict[int, list[OutboxEntry]], sent: list[tuple[int, Notification]]
+    ) -> None:
         """
-        Sends a message to every registered user with newly opened events.
+        Records how long the sent notifications waited in the outbox, and how
+        long after sign up opened the notifications about it went out.
         """
-        for user in self.end_users:
-            for event in new_events.eventrecord.values():
-                try:
-                    await user.send(
-                        f"Nytt event åpnet påmelding ({event.title}): {SITE_PATH}{event.id}/"
-                    )
-
-                # Something bad happened
-                except Exception as e:
-                    logging.warning(
-                        f"Somethng unexpected happened while notifying users of newly opened events: '{e}'"
-                    )
-                    return False
-
-                logging.debug(
-                    f"Messaged user {user} about newly added {event.status} event"
-                )
-
-        # Loop ran wihout problem
-        return True
+        now = time.time()
+        sent = set(sent)
+        for user_id, entries in by_user.items():
+            for entry in entries:
+                if (user_id, entry.notification) not in sent:
+                    continue
+                OUTBOX_WAIT.observe(now - entry.created_at)
+                # The stamp is the sign up start, or "" for events without one
+                stamp = entry.notification.stamp
+                if entry.notification.kind == "opened" and stamp != "":
+                    signup_start = to_datetime(stamp)
+                    SIGNUP_TO_NOTIFY.observe(now - signup_start.timestamp())
 
-    async def notify_users_new_sign_up_start(self, new_events: EventRecord) -> bool:
-        """
-        Sends a message to every registered user with newly opened events.
-        """
-        for user in self.end_users:
-            for event in new_events.eventrecord.values():
-                try:
-                    await user.send(
-                        f"Et event endret når påmeldingen åpner ({event.title}): {SITE_PATH}{event.id}/"
-                        f"Arrangementet åpner nå påmeldingen {event.signup_start}"
-                    )
 
-                # Something bad happened
-                except Exception as e:
-                    logging.warning(
-                        f"Somethng unexpected happened while notifying users of newly changed events: '{e}'"
-                    )
-                    return False
+# Initialized client. The mode can be set per process with the
+# DEPLOYMENT_MODE environment variable, or in .env like BOT_TOKEN.
+load_dotenv()
+client = Client(mode=os.environ.get("DEPLOYMENT_MODE", DEPLOYMENT_MODE))
 
-                logging.debug(
-                    f"Messaged user {user} about newly added {event.status} event"
-                )
 
-        # Loop ran wihout problem
-        return True
+@client.event
+async def on_ready():
+    logging.info(f"Logged in as {client.user}")
 
+    # on_ready is called again on reconnects
+    if client.record is not None:
+        return
 
-# Initialized client
-client = Client()
+    await client.load_end_users()
+    await client.load_record()
+    await client.ledger.load()
+    if METRICS_PORT is not None:
+        client.metrics_server = MetricsServer(METRICS_HOST, METRICS_PORT)
+        await client.metrics_server.start()
+    if client.mode == "notifier":
+        asyncio.create_task(client.feed_loop())
+    else:
+        asyncio.create_task(client.main_loop())
+    asyncio.create_task(client.notifier_loop())
 
 
-@client.event
-async def on_ready():
-    await client.load_end_users(END_USER_PATH)
-    logging.info(f"Logged in as {client.user}")
-    asyncio.create_task(client.main_loop())
+async def run_poller():
+    """
+    Polls the api and publishes the changes to the feed, without connecting
+    to Discord. Used when the mode is "poller", along with a client
+    running as "notifier" that delivers the notifications.
+    """
+    await client.load_record()
+    if POLLER_METRICS_PORT is not None:
+        client.metrics_server = MetricsServer(METRICS_HOST, POLLER_METRICS_PORT)
+        await client.metrics_server.start()
+    await client.main_loop()
 
 
 @client.event
@@ -259,21 +790,27 @@ async def on_message(message: discord.Message):
         return
 
     # Adds user if user writtes start, and removes user if user writes slutt.
+    # Users change what they are notified about with filter, and list events
+    # with åpne, neste and uke.
     logging.debug(f"Recived message from {message.author}")
     if message.content == "start":
         logging.debug(f"Recived 'start' from {message.author}")
-        await client.append_end_user(END_USER_PATH, message.author)
+        await client.append_end_user(message.author)
         await message.reply("Bruker lagt til")
     elif message.content == "slutt":
         logging.debug(f"Recived 'slutt' from {message.author}")
-        await client.remove_end_user(END_USER_PATH, message.author)
+        await client.remove_end_user(message.author)
         await message.reply("Bruker fjernet")
+    elif message.content in ("åpne", "neste", "uke"):
+        logging.debug(f"Recived '{message.content}' from {message.author}")
+        await message.reply(client.answer_query(message.content))
+    elif message.content.split()[:1] == ["filter"]:
+        logging.debug(f"Recived 'filter' from {message.author}")
+        args = message.content.split()[1:]
+        await message.reply(await client.update_subscription(message.author, args))
 
 
 if __name__ == "__main__":
-    from dotenv import load_dotenv
-    from os import environ
-
     # To remove RuntimeError on exit on windows as documented in this issue:
     # https://github.com/encode/httpx/issues/914
     if (
@@ -283,8 +820,6 @@ if __name__ == "__main__":
     ):
         asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
 
-    load_dotenv()
-
     logging.basicConfig(
         format="%(asctime)s.%(msecs)03d [%(levelname)s]%(module)s.%(funcName)s:%(message)s",
         datefmt="%Y-%m-%dT%H:%M:%S",
@@ -292,6 +827,22 @@ if __name__ == "__main__":
         filename=LOG_FILE_PATH,
         encoding="utf8",
     )
+    if TRACE_PATH is not None:
+        export_spans(TRACE_PATH)
 
-    BOT_TOKEN = environ["BOT_TOKEN"]
-    client.run(BOT_TOKEN)
+    if client.mode == "poller":
+        poller = client.loop.create_task(run_poller())
+        try:
+            client.loop.run_until_complete(poller)
+        except KeyboardInterrupt:
+            logging.info("Stopping the poller")
+        finally:
+            # Stops polling, then saves pending changes
+            poller.cancel()
+            client.loop.run_until_complete(
+                asyncio.gather(poller, return_exceptions=True)
+            )
+            client.loop.run_until_complete(client.close())
+    else:
+        BOT_TOKEN = os.environ["BOT_TOKEN"]
+        client.run(BOT_TOKEN)